@@ -1,21 +1,23 @@
 import asyncio
-from http.client import HTTPResponse
-import json
 import logging
 import os
 from pathlib import Path
 import shutil
+import time
 from typing import Any, Dict, List, Optional, Tuple
-import urllib.request
 
 import config
 from core import CoreController
+from core_log import CoreLog
 import dashboard
 import decky
 from decky import logger
+import latency
 
 from external import ExternalServer
+import scheduling
 import subscription
+from traffic import TrafficAggregator
 import upgrade
 import webdav_backup
 from metadata import PACKAGE_NAME
@@ -23,6 +25,37 @@ from settings import SettingsManager
 import utils
 
 
+# settings beyond PERMITTED_KEYS of set_config_value, grouped by how their values are checked
+BOOL_SETTINGS = {
+    "isolated_generation",
+    "keep_core_on_unload",
+    "controller_unix",
+    "traffic_stats",
+}
+STRING_SETTINGS = {"latency_test_url", "auto_select_group"}
+CHOICE_SETTINGS = {
+    "config_backend": [backend.value for backend in config.Backend],
+    "running_config_format": [output_format.value for output_format in config.OutputFormat],
+}
+# key => (type, minimum)
+NUMBER_SETTINGS = {
+    "parse_cache_mb": (int, 0),
+    "core_ready_timeout": (float, 0.0),
+    "core_stop_grace": (float, 0.0),
+    "core_log_max_kb": (int, 1),
+    "core_log_backups": (int, 0),
+    "latency_timeout_ms": (int, 1),
+    "latency_concurrency": (int, 1),
+    "latency_deadline": (float, 1.0),
+    "latency_cache_ttl": (float, 0.0),
+    "latency_history_size": (int, 1),
+    "auto_select_interval": (float, 1.0),
+    "auto_select_hysteresis": (float, 0.0),
+}
+SCHEDULING_SETTINGS = {"core_nice", "core_ionice", "core_cpus", "core_cpu_max", "core_memory_high"}
+CHECKED_SETTINGS = BOOL_SETTINGS | STRING_SETTINGS | CHOICE_SETTINGS.keys() | NUMBER_SETTINGS.keys() | SCHEDULING_SETTINGS
+
+
 class Plugin:
     # Asyncio-compatible long-running code, executed in a task when the plugin is loaded
     async def _main(self):
@@ -42,10 +75,35 @@ class Plugin:
         logger.debug(f"settings: {self.settings.settings}")
 
         utils.init_ssl_context(self._get("disable_verify"))
+        config.set_parse_cache_size(self._get("parse_cache_mb"))
 
-        self.core = CoreController()
+        # keeps LAST_CORE_VERSION, which subscription requests report, in sync with the binary
+        await CoreController.get_version()
+        self.core = CoreController(self._get("core_stop_grace"))
         self.core.set_exit_callback(lambda x: decky.emit("core_exit", x))
-        if self._get("autostart"):
+        self._configure_controller()
+        self.latency_history = latency.LatencyHistory(latency.HISTORY_PATH, self._get("latency_history_size"))
+        self.latency_history.load()
+        self.latency = latency.LatencyTester(
+            self.core.controller,
+            lambda delays: decky.emit("latency_results", delays),
+            self.latency_history,
+        )
+        self.traffic = TrafficAggregator(self.core.controller, lambda: self.core.is_running)
+        if self._get("traffic_stats"):
+            self.traffic.start()
+        self.auto_selector: Optional[latency.AutoSelector] = None
+        self._start_auto_selector()
+        self.core_log = CoreLog(
+            CoreController.LOG_PATH,
+            self._get("core_log_max_kb") * 1024,
+            self._get("core_log_backups"),
+        )
+        self.core_log.start()
+        self.core.sampler.start()
+        if await self._adopt_core():
+            logger.info("reusing core left running by previous plugin instance")
+        elif self._get("autostart"):
             await self.set_core_status(True)
 
         self.external = ExternalServer()
@@ -97,9 +155,36 @@ class Plugin:
 
     # Function called first during the unload process, utilize this to handle your plugin being removed
     async def _unload(self):
+        await self.core_log.stop()
+        await self.core.sampler.stop()
+        if self.auto_selector is not None:
+            await self.auto_selector.stop()
+        await self.traffic.stop()
         if self.core.is_running:
+            if self._get("keep_core_on_unload") and not utils.is_plugin_disabled():
+                # adopted by the next plugin instance, e.g. after plugin_loader restarts
+                self.core.detach()
+            else:
+                await self.core.stop()
+        await self.core.controller.close()
+
+    # Function called after `_unload` during uninstall, utilize this to clean up processes and other remnants
+    async def _uninstall(self):
+        if self.core.is_running or await self.core.adopt():
             await self.core.stop()
 
+    async def _adopt_core(self) -> bool:
+        try:
+            adopted = await self.core.adopt()
+        except Exception as e:
+            logger.error(f"_adopt_core: failed with {e}")
+            logger.debug(f"stack trace: {utils.get_traceback(e)}")
+            return False
+        if adopted:
+            # settings or subscription may have changed while no plugin instance was running
+            await self.restart_core()
+        return adopted
+
     def generate_config(self):
         return config.generate_config(
             subscription.get_path(self._get("current")),
@@ -112,8 +197,15 @@ class Plugin:
             str(dashboard.DASHBOARD_DIR),
             self._get("dashboard", True),
             self._get("skip_steam_download"),
+            config.Backend(self._get("config_backend")),
+            config.OutputFormat(self._get("running_config_format")),
+            controller_unix=CoreController.CONTROLLER_SOCKET if self._get("controller_unix") else None,
+            isolated=self._get("isolated_generation"),
         )
 
+    async def get_generation_stats(self) -> List[Dict[str, Any]]:
+        return config.get_generation_stats()
+
     async def get_core_status(self) -> bool:
         is_running = self.core.is_running
         logger.debug(f"get_core_status: {is_running}")
@@ -123,7 +215,7 @@ class Plugin:
         try:
             if status:
                 await self.generate_config()
-                await self.core.start()
+                await self.core.start(**self._core_start_options())
             else:
                 await self.core.stop()
         except Exception as e:
@@ -132,28 +224,146 @@ class Plugin:
             return False, str(e)
         return True, None
 
-    async def restart_core(self) -> None:
-        logger.debug("soft restarting core ...")
-        await self.generate_config()
-        port = self._get("controller_port")
-        payload = json.dumps({"payload": ""})
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f'Bearer {self._get("secret")}',
-        }
+    async def restart_core(self) -> Tuple[bool, Optional[str]]:
         try:
-            req = urllib.request.Request(f"http://127.0.0.1:{port}/restart",
-                                        data=payload.encode(),
-                                        headers=headers,
-                                        method="POST")
-            resp: HTTPResponse = urllib.request.urlopen(req, timeout=self._get("timeout"))
-            if resp.status != 200:
-                logger.error(f"restart_core: failed with status code {resp.status}")
-                self.core.restart()
+            await self.generate_config()
+            if not self.core.is_running:
+                await self.core.restart(**self._core_start_options())
+                return True, None
+            # the written config may never have been applied, e.g. generated at load or while core was running
+            loaded = self.core.loaded_config
+            if loaded.get('key') is not None and loaded['key'] == config.get_generation_key(CoreController.CONFIG_PATH):
+                changed = []
+            else:
+                changed = config.diff_sections(
+                    loaded.get('sections'),
+                    config.get_section_digests(CoreController.CONFIG_PATH),
+                )
+            if not changed:
+                logger.debug("restart_core: running config unchanged, skipping")
+                return True, None
+            logger.debug(f"restart_core: changed keys: {changed}")
+            begin = time.perf_counter()
+            if config.UNKNOWN_CHANGE in changed or not config.RESTART_KEYS.isdisjoint(changed):
+                # the controller address or secret the running core knows is stale
+                method = "restart"
+                await self.core.restart(**self._core_start_options())
+            elif config.LIVE_KEYS.issuperset(changed) and await self._patch_config(changed):
+                method = "patch"
+                self.core.record_config()
+            elif await self._reload_config():
+                method = "reload"
+                self.core.record_config()
+            else:
+                method = "restart"
+                await self.core.restart(**self._core_start_options())
+            logger.info(f"restart_core: applied by {method} in {time.perf_counter() - begin:.3f}s")
         except Exception as e:
             logger.error(f"restart_core: failed with {e}")
             logger.debug(f"stack trace: {utils.get_traceback(e)}")
-            self.core.restart()
+            return False, str(e)
+        return True, None
+
+    def _configure_controller(self) -> None:
+        self.core.configure_controller(self._get("controller_port"), self._get("secret"), self._get("controller_unix"))
+
+    def _core_start_options(self) -> Dict[str, Any]:
+        # the core is started with the credentials of the running config just generated
+        self._configure_controller()
+        self.core.configure_scheduling(self._scheduling_profile())
+        deadline = self._get("core_ready_timeout")
+        return {
+            "wait_ready": deadline > 0,
+            "deadline": deadline,
+            "label": self._get("current") or "",
+        }
+
+    def _scheduling_profile(self) -> Dict[str, Any]:
+        return {key: self._get(f"core_{key}") for key in ("nice", "ionice", "cpus", "cpu_max", "memory_high")}
+
+    async def get_core_startup_stats(self) -> List[Dict[str, Any]]:
+        return self.core.get_startup_stats()
+
+    async def get_core_stop_stats(self) -> List[Dict[str, Any]]:
+        return self.core.get_stop_stats()
+
+    async def get_core_scheduling(self) -> Dict[str, Any]:
+        return self.core.get_scheduling()
+
+    async def get_resource_stats(self, points: int) -> Dict[str, Any]:
+        return self.core.sampler.stats(points)
+
+    async def get_core_log(self, lines: int) -> List[str]:
+        return self.core_log.tail(lines)
+
+    async def search_core_log(self, level: Optional[str], pattern: Optional[str], limit: int) -> Tuple[List[str], Optional[str]]:
+        try:
+            return await asyncio.to_thread(self.core_log.search, level, pattern, limit), None
+        except ValueError as e:
+            logger.error(f"search_core_log: {e}")
+            return [], str(e)
+
+    async def test_proxy_latency(self, group: Optional[str], force: bool) -> Tuple[Dict[str, Optional[int]], Optional[str]]:
+        if not self.core.is_running:
+            return {}, "core is not running"
+        try:
+            delays = await self._test_latency(group, force)
+        except Exception as e:
+            logger.error(f"test_proxy_latency: failed with {e}")
+            logger.debug(f"stack trace: {utils.get_traceback(e)}")
+            return {}, str(e)
+        return delays, None
+
+    async def _test_latency(self, group: Optional[str], force: bool) -> Dict[str, Optional[int]]:
+        return await self.latency.test(
+            group,
+            self._get("latency_test_url"),
+            self._get("latency_timeout_ms"),
+            self._get("latency_concurrency"),
+            self._get("latency_deadline"),
+            self._get("latency_cache_ttl"),
+            force,
+        )
+
+    async def get_latency_history(self) -> Dict[str, Dict[str, Any]]:
+        return self.latency_history.all_stats()
+
+    async def get_traffic_stats(self, points: int) -> Dict[str, Any]:
+        return self.traffic.snapshot(points)
+
+    async def _patch_config(self, keys: List[str]) -> bool:
+        try:
+            values = await asyncio.to_thread(config.read_sections, CoreController.CONFIG_PATH, keys)
+        except Exception as e:
+            logger.error(f"_patch_config: failed to read running config with {e}")
+            return False
+        if values.keys() != set(keys):
+            # removed keys cannot be reset through PATCH
+            logger.debug(f"_patch_config: missing keys {set(keys) - values.keys()}")
+            return False
+        try:
+            await self.core.controller.patch_configs(values)
+        except Exception as e:
+            logger.error(f"_patch_config: failed with {e}")
+            return False
+        return True
+
+    async def _reload_config(self) -> bool:
+        try:
+            # loading providers of a new config may take a while
+            await self.core.controller.reload_configs(CoreController.CONFIG_PATH, timeout=self._get("timeout"))
+        except Exception as e:
+            logger.error(f"_reload_config: failed with {e}")
+            return False
+        return True
+
+    async def get_controller_metrics(self) -> Dict[str, Dict[str, float]]:
+        return self.core.controller.get_metrics()
+
+    async def benchmark_controller(self, rounds: int) -> Dict[str, Optional[Dict[str, float]]]:
+        if not self.core.is_running:
+            return {"unix": None, "tcp": None}
+        return await self.core.controller.benchmark(rounds)
 
     async def kill_core(self) -> bool:
         return CoreController.kill(self._get("timeout"))
@@ -174,6 +384,20 @@ class Plugin:
         logger.debug(config)
         return config
 
+    def _start_auto_selector(self) -> None:
+        if not self._get("auto_select_group"):
+            return
+        self.auto_selector = latency.AutoSelector(
+            self.core.controller,
+            self.latency_history,
+            lambda group: self._test_latency(group, True),
+            lambda: self.core.is_running,
+            self._get("auto_select_group"),
+            self._get("auto_select_interval"),
+            self._get("auto_select_hysteresis"),
+        )
+        self.auto_selector.start()
+
     async def get_config_value(self, key: str):
         value = self.settings.getSetting(key)
         logger.debug(f"get_config_value: {key} => {value}")
@@ -191,11 +415,67 @@ class Plugin:
             "auto_update_subscription",
             "skip_steam_download",
         ]
-        if key not in PERMITTED_KEYS:
+        if key not in PERMITTED_KEYS and key not in CHECKED_SETTINGS:
             logger.error(f"set_config_value: not permitted key {key}")
             return
+        if key in CHECKED_SETTINGS:
+            try:
+                value = self._check_setting(key, value)
+            except ValueError as e:
+                logger.error(f"set_config_value: invalid {key}: {e}")
+                return
         self.settings.setSetting(key, value)
         logger.debug(f"set_config_value: {key} => {value}")
+        await self._apply_setting(key)
+
+    def _check_setting(self, key: str, value: Any) -> Any:
+        """
+        Check a value of a setting the way they are checked on load
+        Returns:
+            Any: Value to store, numbers converted to the type of their default
+        Raises:
+            ValueError: When value is not acceptable for key
+        """
+        if key in BOOL_SETTINGS:
+            if not isinstance(value, bool):
+                raise ValueError(f"{value!r} is not a boolean")
+        elif key in STRING_SETTINGS:
+            if not isinstance(value, str):
+                raise ValueError(f"{value!r} is not a string")
+            value = value.strip()
+        elif key in CHOICE_SETTINGS:
+            if value not in CHOICE_SETTINGS[key]:
+                raise ValueError(f"{value!r} is not one of {CHOICE_SETTINGS[key]}")
+        elif key in NUMBER_SETTINGS:
+            kind, minimum = NUMBER_SETTINGS[key]
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{value!r} is not a number")
+            if kind is int and value != int(value):
+                raise ValueError(f"{value!r} is not an integer")
+            value = kind(value)
+            if value < minimum:
+                raise ValueError(f"{value!r} is less than {minimum}")
+        else:
+            name = key.removeprefix("core_")
+            profile = {**self._scheduling_profile(), name: value}
+            if scheduling.validate(profile)[name] != value:
+                raise ValueError(f"{value!r} is not a valid scheduling value")
+        return value
+
+    async def _apply_setting(self, key: str) -> None:
+        # settings read only on load, others are read whenever they are used
+        if key == "parse_cache_mb":
+            config.set_parse_cache_size(self._get(key))
+        elif key == "traffic_stats":
+            if self._get(key):
+                self.traffic.start()
+            else:
+                await self.traffic.stop()
+        elif key.startswith("auto_select_"):
+            if self.auto_selector is not None:
+                await self.auto_selector.stop()
+                self.auto_selector = None
+            self._start_auto_selector()
 
     async def get_webdav_config(self) -> dict:
         config = {
@@ -297,7 +577,7 @@ class Plugin:
                     if version[0].isdigit():
                         version = "v" + version
                 case upgrade.ResourceType.CORE:
-                    version = CoreController.get_version()
+                    version = await CoreController.get_version()
         except Exception as e:
             logger.error(f"get_version: {res} failed with {type(e)} {e}")
             logger.debug(f"stack trace: {utils.get_traceback(e)}")
@@ -305,6 +585,9 @@ class Plugin:
         logger.debug(f"get_version: {res} {version}")
         return version
 
+    async def get_core_variant(self) -> str:
+        return upgrade.get_core_variant()
+
     async def get_latest_version(self, res: str, channel: str = "") -> str:
         if res not in upgrade.RESOURCE_TYPE_VALUES:
             logger.error(f"get_latest_version: invalid resource {res}")
@@ -355,7 +638,7 @@ class Plugin:
         )
         if result is None:
             if self.core.is_running and name == self._get("current"):
-                await self.restart_core()
+                return await self.restart_core()
             return True, None
         else:
             return False, result
@@ -401,6 +684,7 @@ class Plugin:
         new_name = utils.sanitize_filename(new_name)
         logger.info(f"edit_subscription: {name} => {new_name}, {new_url}")
         if name in subs:
+            config.remove_parse_cache(subscription.get_path(name))
             if new_name == name:
                 subs[name] = new_url
             elif new_name in subs:
@@ -424,7 +708,7 @@ class Plugin:
 
     async def download_subscription(self, url: str) -> Tuple[bool, Optional[str]]:
         subs: subscription.SubscriptionDict = self.settings.getSetting("subscriptions")
-        ok, data = subscription.download_sub(
+        ok, data = await subscription.download_sub(
             url,
             subs,
             self._get("timeout"),
@@ -443,7 +727,7 @@ class Plugin:
 
     async def import_subscription_file(self, file_name: str, file_bytes: bytes) -> Tuple[bool, Optional[str]]:
         subs: subscription.SubscriptionDict = self.settings.getSetting("subscriptions")
-        ok, data = subscription.import_sub(file_name, file_bytes, subs)
+        ok, data = await subscription.import_sub(file_name, file_bytes, subs)
         if ok:
             name, url = data
             subs[name] = url
@@ -460,6 +744,7 @@ class Plugin:
         subs: subscription.SubscriptionDict = self.settings.getSetting("subscriptions")
         if name in subs:
             subs.pop(name)
+            config.remove_parse_cache(subscription.get_path(name))
             try:
                 os.remove(subscription.get_path(name))
             except Exception as e:
@@ -542,6 +827,15 @@ class Plugin:
             name="config", settings_directory=decky.DECKY_PLUGIN_SETTINGS_DIR
         )
         self._initialize_settings_defaults()
+        self._validate_scheduling_settings()
+
+    def _validate_scheduling_settings(self) -> None:
+        # an invalid value would otherwise fail in the forked child and abort every core start
+        profile = self._scheduling_profile()
+        for key, value in scheduling.validate(profile).items():
+            if value != profile[key]:
+                logger.warning(f"_validate_scheduling_settings: resetting core_{key}")
+                self.settings.setSetting(f"core_{key}", value)
 
     def _set_default(self, key: str, value: Any) -> None:
         if self.settings.getSetting(key) is None:
@@ -565,6 +859,31 @@ class Plugin:
         self._set_default("auto_update_subscription", False)
         self._set_default("skip_steam_download", False)
         self._set_default("log_level", logging.getLevelName(logging.INFO))
+        self._set_default("parse_cache_mb", 256)
+        self._set_default("config_backend", config.Backend.RoundTrip.value)
+        self._set_default("running_config_format", config.OutputFormat.YAML.value)
+        self._set_default("isolated_generation", False)
+        self._set_default("core_ready_timeout", 10.0)
+        self._set_default("core_stop_grace", 5.0)
+        self._set_default("keep_core_on_unload", True)
+        self._set_default("core_log_max_kb", 1024)
+        self._set_default("core_log_backups", 2)
+        self._set_default("core_nice", 0)
+        self._set_default("core_ionice", "")
+        self._set_default("core_cpus", [])
+        self._set_default("core_cpu_max", "")
+        self._set_default("core_memory_high", "")
+        self._set_default("controller_unix", True)
+        self._set_default("latency_test_url", "https://www.gstatic.com/generate_204")
+        self._set_default("latency_timeout_ms", 5000)
+        self._set_default("latency_concurrency", 16)
+        self._set_default("latency_deadline", 30.0)
+        self._set_default("latency_cache_ttl", 300.0)
+        self._set_default("latency_history_size", 32)
+        self._set_default("auto_select_group", "")
+        self._set_default("auto_select_interval", 300.0)
+        self._set_default("auto_select_hysteresis", 0.3)
+        self._set_default("traffic_stats", True)
         self._set_default("webdav_url", "")
         self._set_default("webdav_username", "")
         self._set_default("webdav_password", "")
@@ -1,25 +1,191 @@
+import asyncio
+from collections import deque
+from collections.abc import Set as AbstractSet
+import datetime
 from enum import Enum
+import hashlib
+import io
+import json
+import multiprocessing
+from multiprocessing.connection import Connection
 import os
-from typing import Optional
+import resource
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, TextIO, Tuple
 
 from dashboard import BUILTIN_DASHBOARDS
 from ruamel.yaml import YAML
+from ruamel.yaml.main import CParser
 import decky
 from decky import logger
 from ruamel.yaml.comments import CommentedMap
+from ruamel.yaml.scalarbool import ScalarBoolean
+import parse_cache
+import splicer
+import utils
 
 OVERRIDE_YAML = os.path.join(decky.DECKY_PLUGIN_DIR, 'override.yaml')
+META_SUFFIX = '.meta'
+WRITE_BUFFER_SIZE = 1 << 20
 
-yaml = YAML()
-yaml.width = float("inf")
-yaml.preserve_quotes = True
+# changed keys reported when sections of either config are unknown
+UNKNOWN_CHANGE = '*'
+# keys applied by mihomo through PATCH /configs without reloading
+LIVE_KEYS = {
+    'port', 'socks-port', 'redir-port', 'tproxy-port', 'mixed-port',
+    'allow-lan', 'bind-address', 'mode', 'log-level', 'ipv6',
+    'tcp-concurrent', 'interface-name', 'tun',
+}
+# keys the controller itself depends on, changing them needs a process restart
+RESTART_KEYS = {'external-controller', 'external-controller-unix', 'secret'}
+
+# never fold long lines, the largest width CEmitter accepts
+FAST_WIDTH = 2 ** 31 - 1
+
+class Backend(Enum):
+    RoundTrip = 'roundtrip'
+    Fast      = 'fast'
+
+def _new_yaml(backend: Backend) -> YAML:
+    if backend == Backend.Fast:
+        # plain dict/list, uses CParser/CEmitter if available and pure python otherwise
+        y = YAML(typ='safe')
+        y.default_flow_style = False
+        y.sort_base_mapping_type_on_output = False
+        # CEmitter takes a C int, infinity overflows it
+        y.width = FAST_WIDTH
+    else:
+        y = YAML()
+        y.preserve_quotes = True
+        y.width = float("inf")
+    return y
+
+_parse_cache = parse_cache.ParseCache(256 * 1024 * 1024)
+_disk_cache = parse_cache.DiskCache(parse_cache.CACHE_DIR)
 
 class EnhancedMode(Enum):
     RedirHost = 'redir-host'
     FakeIP    = 'fake-ip'
 
+class OutputFormat(Enum):
+    YAML = 'yaml'
+    JSON = 'json'
+
+
+class GenerationSuperseded(Exception):
+    pass
+
+_generation_seq = 0
+_generation_task: Optional[asyncio.Future] = None
+_generation_stats: Deque[Dict[str, Any]] = deque(maxlen=20)
+_write_lock = threading.Lock()
+
+async def generate_config(*args, isolated: bool = False, **kwargs) -> List[str]:
+    """
+    Run generate_config_sync in a worker thread, or in a short-lived child
+    process if isolated, superseding any generation still in flight.
+    Superseded callers wait for the newest generation instead.
+    """
+    global _generation_seq, _generation_task
+    _generation_seq += 1
+    seq = _generation_seq
+    cancelled = lambda: seq != _generation_seq
+    _kill_isolated()
+    if isolated:
+        task = asyncio.ensure_future(_generate_isolated(args, kwargs, cancelled))
+    else:
+        task = asyncio.ensure_future(asyncio.to_thread(
+            generate_config_sync, *args, **kwargs, cancelled=cancelled))
+    _generation_task = task
+    while True:
+        try:
+            return await asyncio.shield(task)
+        except GenerationSuperseded:
+            assert _generation_task is not None
+            logger.debug(f'generate_config: generation {seq} superseded')
+            task = _generation_task
+
+_isolated_process: Optional[multiprocessing.Process] = None
+
+async def _generate_isolated(args: tuple, kwargs: dict, cancelled: Callable[[], bool]) -> List[str]:
+    global _isolated_process
+    _check_cancelled(cancelled)
+    # fork keeps working when the loader is a frozen executable
+    ctx = multiprocessing.get_context('fork')
+    reader, writer = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_isolated_main, args=(writer, args, kwargs, cancelled), daemon=True)
+    proc.start()
+    writer.close()
+    _isolated_process = proc
+    logger.debug(f'generate_config: isolated generation in pid {proc.pid}')
 
-async def generate_config(
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(reader.fileno(), lambda: readable.done() or readable.set_result(None))
+    try:
+        await readable
+        try:
+            changed, stats, error = reader.recv()
+        except EOFError:
+            if cancelled():
+                raise GenerationSuperseded()
+            raise RuntimeError(f'generation process exited with code {proc.exitcode}')
+    finally:
+        loop.remove_reader(reader.fileno())
+        reader.close()
+        if _isolated_process is proc:
+            _isolated_process = None
+        await asyncio.to_thread(proc.join)
+
+    if stats is not None:
+        stats['isolated'] = True
+        _generation_stats.append(stats)
+        logger.info(f"generate_config: isolated peak RSS {stats['peak_rss'] // 1024} KiB "
+                    f"(started at {stats['start_rss'] // 1024} KiB)")
+    if error is not None:
+        if error == GenerationSuperseded.__name__:
+            raise GenerationSuperseded()
+        raise RuntimeError(error)
+    return changed
+
+def _isolated_main(writer: Connection, args: tuple, kwargs: dict, cancelled: Callable[[], bool]) -> None:
+    global _parse_cache, _write_lock
+    # nothing survives this process, locks may have been held by other threads at fork
+    _parse_cache = parse_cache.ParseCache(0)
+    _write_lock = threading.Lock()
+    _generation_stats.clear()
+    start_rss = _read_rss()
+    changed, error = None, None
+    try:
+        changed = generate_config_sync(*args, **kwargs, cancelled=cancelled)
+    except GenerationSuperseded:
+        error = GenerationSuperseded.__name__
+    except BaseException as e:
+        error = f'{type(e).__name__}: {e}'
+    stats = _generation_stats[-1] if _generation_stats else None
+    if stats is not None:
+        stats['start_rss'] = start_rss
+        stats['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    writer.send((changed, stats, error))
+    writer.close()
+
+def _kill_isolated() -> None:
+    if _isolated_process is not None and _isolated_process.is_alive():
+        logger.debug(f'generate_config: killing superseded generation pid {_isolated_process.pid}')
+        _isolated_process.kill()
+
+def _read_rss() -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def get_generation_stats() -> List[Dict[str, Any]]:
+    return list(_generation_stats)
+
+def generate_config_sync(
         ori_path: str,
         new_path: str,
         secret: str,
@@ -30,32 +196,264 @@ async def generate_config(
         dashboard_dir: str,
         dashboard: Optional[str],
         skip_steam_download: bool,
-        ) -> None:
-    with open(ori_path) as f:
-        config = yaml.load(f)
-    logger.debug(f'generate_config: config: {config}')
-    with open(OVERRIDE_YAML) as f:
-        override_config = yaml.load(f)
+        backend: Backend = Backend.RoundTrip,
+        output_format: OutputFormat = OutputFormat.YAML,
+        controller_unix: Optional[str] = None,
+        cancelled: Callable[[], bool] = lambda: False,
+        ) -> List[str]:
+    """
+    Generate running config from subscription and override manifest
+    Returns:
+        List[str]: Changed top-level keys of running config, empty if it is already up to date
+    Raises:
+        GenerationSuperseded: When cancelled returns True before writing
+    """
+    stats: Dict[str, Any] = {'time': time.time(), 'method': 'cached'}
+    timer = _StageTimer(stats)
+
+    ori_stat = parse_cache.stat_key(ori_path)
+    with open(ori_path, 'rb') as f:
+        ori_bytes = f.read()
+    with open(OVERRIDE_YAML, 'rb') as f:
+        override_bytes = f.read()
+    ori_digest = hashlib.sha256(ori_bytes).hexdigest()
+    key = _generation_key(ori_digest, override_bytes, {
+        'secret': secret,
+        'override_dns': override_dns,
+        'enhanced_mode': enhanced_mode.value,
+        'controller_port': controller_port,
+        'allow_remote_access': allow_remote_access,
+        'dashboard_dir': dashboard_dir,
+        'dashboard': dashboard,
+        'skip_steam_download': skip_steam_download,
+        'backend': backend.value,
+        'output_format': output_format.value,
+        'controller_unix': controller_unix,
+    })
+    stats['size'] = len(ori_bytes)
+    timer.lap('read')
+    if os.path.exists(new_path) and get_generation_key(new_path) == key:
+        logger.debug(f'generate_config: {new_path} is up to date, skipping')
+        timer.finish()
+        return []
+    _check_cancelled(cancelled)
+
+    y = _new_yaml(backend)
+    logger.debug(f'generate_config: backend {backend.value}, C parser {"available" if CParser else "unavailable"}')
+    override_config = y.load(override_bytes)
     logger.debug(f'generate_config: override_config: {override_config}')
+    overrides = CommentedMap() if backend == Backend.RoundTrip else {}
     if override_dns:
-        config['dns'] = override_config['dns-override']
-        _merge_dict(config['dns'], override_config[f'{enhanced_mode.value}-dns'])
+        overrides['dns'] = override_config['dns-override']
+        _merge_dict(overrides['dns'], override_config[f'{enhanced_mode.value}-dns'])
+    prepends = {}
     if skip_steam_download:
-        config['rules'] = override_config['skip-steam-rules'] + config['rules']
+        prepends['rules'] = override_config['skip-steam-rules']
 
-    config['external-controller'] = f'{"0.0.0.0" if allow_remote_access else "127.0.0.1"}:{controller_port}'
-    config['secret'] = secret
-    config['external-ui'] = dashboard_dir
+    overrides['external-controller'] = f'{"0.0.0.0" if allow_remote_access else "127.0.0.1"}:{controller_port}'
+    if controller_unix is not None:
+        overrides['external-controller-unix'] = controller_unix
+    overrides['secret'] = secret
+    overrides['external-ui'] = dashboard_dir
     if dashboard is not None:
-        config['external-ui-name'] = dashboard
+        overrides['external-ui-name'] = dashboard
         if dashboard in BUILTIN_DASHBOARDS:
-            config['external-ui-url'] = BUILTIN_DASHBOARDS[dashboard]
+            overrides['external-ui-url'] = BUILTIN_DASHBOARDS[dashboard]
+
+    overrides['tun'] = override_config['tun-override']
+    _merge_dict(overrides, override_config['always-override'])
+
+    text = None
+    sections = None
+    if output_format == OutputFormat.YAML:
+        try:
+            text = splicer.splice(
+                ori_bytes.decode('utf-8'),
+                overrides,
+                prepends,
+                lambda data: _dump_str(y, data),
+                y.load,
+            )
+            stats['method'] = 'splice'
+            timer.lap('splice')
+        except (UnicodeDecodeError, splicer.Unsupported) as e:
+            logger.info(f'generate_config: falling back to full round-trip: {e}')
+
+    if text is None:
+        # formatting kept by round-trip trees only matters for YAML output, plain data is persisted otherwise
+        if backend == Backend.Fast or output_format == OutputFormat.JSON:
+            tag = backend.value
+            load = lambda data: _disk_cache.load(ori_path, ori_digest, data, y.load, backend.value)
+        else:
+            tag = f'{backend.value}-tree'
+            load = y.load
+        config = _parse_cache.load(ori_path, load, ori_bytes, ori_stat, tag)
+        logger.debug(f'generate_config: config: {config}')
+        for k, v in prepends.items():
+            config[k] = v + config[k]
+        _merge_dict(config, overrides)
+        stats['method'] = 'full'
+        timer.lap('parse')
+        _check_cancelled(cancelled)
+        if output_format == OutputFormat.JSON:
+            # round-trip loader only yields int-based ScalarBoolean for anchored booleans
+            convert_bools = backend == Backend.RoundTrip \
+                and splicer.has_anchors(ori_bytes.decode('utf-8', 'replace'))
+            try:
+                text, sections = _dump_json(config, convert_bools)
+                stats['method'] = 'json'
+                timer.lap('dump')
+            except (TypeError, ValueError) as e:
+                logger.warning(f'generate_config: cannot emit JSON, using YAML: {e}')
+
+    with _write_lock:
+        # never let a stale generation overwrite a newer one
+        _check_cancelled(cancelled)
+        old_sections = _read_meta(new_path).get('sections')
+        # the meta goes first, so a crash in between never pairs it with another config
+        _remove_meta(new_path)
+        if text is None:
+            utils.atomic_write(new_path, lambda f: y.dump(config, f), WRITE_BUFFER_SIZE)
+            with open(new_path, encoding='utf-8') as f:
+                text = f.read()
+        else:
+            utils.atomic_write(new_path, lambda f: f.write(text), WRITE_BUFFER_SIZE)
+        timer.lap('write')
+        if sections is None:
+            sections = _section_digests(text)
+        utils.atomic_write(new_path + META_SUFFIX, lambda f: json.dump({'key': key, 'sections': sections}, f))
+    changed = diff_sections(old_sections, sections)
+    stats['changed'] = changed
+    timer.lap('diff')
+    timer.finish()
+    return changed
+
+class _StageTimer:
+    def __init__(self, stats: Dict[str, Any]):
+        self._stats = stats
+        self._start = self._last = time.perf_counter()
+        stats['stages'] = {}
+
+    def lap(self, stage: str) -> None:
+        now = time.perf_counter()
+        self._stats['stages'][stage] = now - self._last
+        self._last = now
+
+    def finish(self) -> None:
+        self._stats['duration'] = time.perf_counter() - self._start
+        _generation_stats.append(self._stats)
+        logger.info(f"generate_config: {self._stats['method']} in {self._stats['duration']:.3f}s "
+                    f"({', '.join(f'{k} {v:.3f}s' for k, v in self._stats['stages'].items())})")
+
+def _check_cancelled(cancelled: Callable[[], bool]) -> None:
+    if cancelled():
+        raise GenerationSuperseded()
+
+def _dump_str(y: YAML, data: Any) -> str:
+    stream = io.StringIO()
+    y.dump(data, stream)
+    return stream.getvalue()
+
+def _dump_json(data: Any, convert_bools: bool) -> Tuple[str, Dict[str, str]]:
+    # mihomo reads running config with a YAML parser, which accepts JSON as is
+    if convert_bools:
+        data = _convert_bools(data)
+    encode = json.JSONEncoder(
+        default=_json_default,
+        allow_nan=False,
+        ensure_ascii=False,
+        separators=(',', ':'),
+    ).encode
+    chunks = []
+    sections = {}
+    for k, v in data.items():
+        if not isinstance(k, str):
+            raise TypeError(f'non-string top-level key: {k!r}')
+        value = encode(v)
+        sections[k] = _digest(value)
+        chunks.append(f'{encode(k)}:{value}')
+    return '{' + ','.join(chunks) + '}', sections
+
+def _convert_bools(data: Any) -> Any:
+    if isinstance(data, ScalarBoolean):
+        return bool(data)
+    if isinstance(data, dict):
+        return {k: _convert_bools(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_convert_bools(v) for v in data]
+    return data
+
+def _json_default(o: Any) -> Any:
+    if isinstance(o, (datetime.date, datetime.datetime)):
+        return o.isoformat()
+    if isinstance(o, bytes):
+        return o.decode('utf-8')
+    if isinstance(o, AbstractSet):
+        return list(o)
+    raise TypeError(f'{type(o).__name__} is not JSON serializable')
+
+def set_parse_cache_size(size_mb: int) -> None:
+    _parse_cache.set_budget(size_mb * 1024 * 1024)
+
+def get_generation_key(path: str) -> Optional[str]:
+    return _read_meta(path).get('key')
+
+def get_section_digests(path: str) -> Optional[Dict[str, str]]:
+    return _read_meta(path).get('sections')
+
+def diff_sections(old: Optional[Dict[str, str]], new: Optional[Dict[str, str]]) -> List[str]:
+    if not old or not new:
+        return [UNKNOWN_CHANGE]
+    return sorted(k for k in old.keys() | new.keys() if old.get(k) != new.get(k))
+
+def read_sections(path: str, keys: Iterable[str]) -> Dict[str, Any]:
+    """
+    Read values of top-level keys from running config, only parsing the needed sections
+    """
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    keys = set(keys)
+    if text.startswith('{'):
+        data = json.loads(text)
+        return {k: data[k] for k in keys if k in data}
+    y = _new_yaml(Backend.Fast)
+    return {k: y.load(body)[k] for k, body in splicer.split_sections(text) if k in keys}
+
+def _section_digests(text: str) -> Optional[Dict[str, str]]:
+    try:
+        return {k: _digest(body) for k, body in splicer.split_sections(text) if k is not None}
+    except splicer.Unsupported as e:
+        logger.debug(f'generate_config: cannot split running config: {e}')
+        return None
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _read_meta(path: str) -> Dict[str, Any]:
+    try:
+        with open(path + META_SUFFIX) as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def remove_parse_cache(ori_path: str) -> None:
+    _parse_cache.invalidate(ori_path)
+    _disk_cache.remove(ori_path)
+
+def _generation_key(ori_digest: str, override_bytes: bytes, params: dict) -> str:
+    h = hashlib.sha256()
+    h.update(decky.DECKY_PLUGIN_VERSION.encode())
+    h.update(ori_digest.encode())
+    h.update(hashlib.sha256(override_bytes).digest())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
 
-    config['tun'] = override_config['tun-override']
-    _merge_dict(config, override_config['always-override'])
-    with open(new_path, 'w') as f:
-        yaml.dump(config, f)
+def _remove_meta(path: str) -> None:
+    try:
+        os.remove(path + META_SUFFIX)
+    except FileNotFoundError:
+        pass
 
-def _merge_dict(a: CommentedMap, b: CommentedMap) -> None:
+def _merge_dict(a: dict, b: dict) -> None:
     for k, v in b.items():
         a[k] = v
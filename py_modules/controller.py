@@ -0,0 +1,312 @@
+import asyncio
+import json
+import os
+import statistics
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+import urllib.parse
+
+import aiohttp
+
+from decky import logger
+
+DEFAULT_TIMEOUT = 5.0
+# callers such as delay tests bound their own concurrency, the pool only guards against runaways
+CONNECTION_LIMIT = 128
+KEEPALIVE_TIMEOUT = 60
+
+T = TypeVar("T")
+
+
+class ControllerError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class ControllerClient:
+    """
+    Client of mihomo external controller, keeping one keep-alive session per transport.
+    Latency of every call is recorded per endpoint.
+    """
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT):
+        self._timeout = timeout
+        self._port: Optional[int] = None
+        self._secret = ""
+        self._unix_path: Optional[str] = None
+        # keyed by "tcp" or socket path
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._metrics: Dict[str, Dict[str, float]] = {}
+
+    @property
+    def is_configured(self) -> bool:
+        return self._port is not None
+
+    def configure(self, port: int, secret: str, unix_path: Optional[str] = None) -> None:
+        """
+        Set controller address, calls go through unix_path when set and fall back to TCP port
+        """
+        self._port = port
+        self._secret = secret
+        self._unix_path = unix_path
+
+    async def close(self) -> None:
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            await session.close()
+
+    def get_metrics(self) -> Dict[str, Dict[str, float]]:
+        return {endpoint: dict(m) for endpoint, m in self._metrics.items()}
+
+    async def version(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        return await self.request("GET", "/version", timeout=timeout)
+
+    async def get_configs(self) -> Dict[str, Any]:
+        return await self.request("GET", "/configs")
+
+    async def patch_configs(self, values: Dict[str, Any]) -> None:
+        await self.request("PATCH", "/configs", values)
+
+    async def reload_configs(self, path: str, force: bool = True, timeout: Optional[float] = None) -> None:
+        await self.request("PUT", "/configs", {"path": path}, params={"force": str(force).lower()}, timeout=timeout)
+
+    async def restart(self) -> None:
+        await self.request("POST", "/restart", {"path": ""})
+
+    async def proxies(self) -> Dict[str, Any]:
+        return (await self.request("GET", "/proxies"))["proxies"]
+
+    async def select_proxy(self, group: str, name: str) -> None:
+        await self.request("PUT", f"/proxies/{_quote(group)}", {"name": name}, endpoint="/proxies/{group}")
+
+    async def proxy_delay(self, name: str, url: str, timeout_ms: int) -> int:
+        result = await self.request(
+            "GET",
+            f"/proxies/{_quote(name)}/delay",
+            params={"url": url, "timeout": str(timeout_ms)},
+            timeout=timeout_ms / 1000 + 1,
+            endpoint="/proxies/{name}/delay",
+        )
+        return result["delay"]
+
+    async def providers(self) -> Dict[str, Any]:
+        return (await self.request("GET", "/providers/proxies"))["providers"]
+
+    async def update_provider(self, name: str) -> None:
+        await self.request("PUT", f"/providers/proxies/{_quote(name)}", endpoint="/providers/proxies/{name}")
+
+    async def connections(self) -> Dict[str, Any]:
+        return await self.request("GET", "/connections")
+
+    async def close_connections(self) -> None:
+        await self.request("DELETE", "/connections")
+
+    def traffic(self) -> AsyncIterator[Dict[str, Any]]:
+        return self.stream("/traffic")
+
+    def logs(self, level: str = "info") -> AsyncIterator[Dict[str, Any]]:
+        return self.stream("/logs", params={"level": level})
+
+    def watch_connections(self, interval_ms: int) -> AsyncIterator[Dict[str, Any]]:
+        # only served over websocket, a plain GET returns a single snapshot
+        return self.websocket("/connections", params={"interval": str(interval_ms)})
+
+    async def benchmark(self, rounds: int) -> Dict[str, Optional[Dict[str, float]]]:
+        """
+        Measure round trip of GET /version through each transport
+        Returns:
+            Dict[str, Optional[Dict[str, float]]]: Latency summary in seconds per transport, None when it is not available
+        """
+        result: Dict[str, Optional[Dict[str, float]]] = {}
+        for transport in ("unix", "tcp"):
+            if transport == "unix" and not self._unix_available():
+                result[transport] = None
+                continue
+            latencies = []
+            try:
+                for _ in range(rounds):
+                    begin = time.perf_counter()
+                    await self.request("GET", "/version", transport=transport)
+                    latencies.append(time.perf_counter() - begin)
+            except (ControllerError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"benchmark: {transport} failed with {e}")
+            if not latencies:
+                result[transport] = None
+                continue
+            latencies.sort()
+            result[transport] = {
+                "rounds": len(latencies),
+                "mean": statistics.fmean(latencies),
+                "p50": latencies[len(latencies) // 2],
+                "p95": latencies[min(len(latencies) - 1, len(latencies) * 95 // 100)],
+                "max": latencies[-1],
+            }
+        return result
+
+    async def request(
+            self,
+            method: str,
+            path: str,
+            body: Any = None,
+            params: Optional[Dict[str, str]] = None,
+            timeout: Optional[float] = None,
+            endpoint: Optional[str] = None,
+            transport: Optional[str] = None,
+            ) -> Any:
+        """
+        Call controller API
+        Args:
+            method: HTTP method
+            path: API path
+            body: JSON body
+            params: Query parameters
+            timeout: Total timeout of this call, the client default when None
+            endpoint: Name metrics are recorded under, path when None
+            transport: "unix" or "tcp", the unix socket with TCP fallback when None
+        Returns:
+            Any: Parsed JSON response, None when empty
+        Raises:
+            ControllerError: When controller answers with an error status
+            aiohttp.ClientError: When controller is unreachable
+            asyncio.TimeoutError: When controller does not answer in time
+        """
+        begin = time.perf_counter()
+        ok = False
+        try:
+            result = await self._connect(
+                path,
+                lambda session, url: self._request(session, url, method, body, params, timeout),
+                transport,
+            )
+            ok = True
+            return result
+        finally:
+            self._record(f"{method} {endpoint or path}", time.perf_counter() - begin, ok)
+
+    async def _request(
+            self,
+            session: aiohttp.ClientSession,
+            url: str,
+            method: str,
+            body: Any,
+            params: Optional[Dict[str, str]],
+            timeout: Optional[float],
+            ) -> Any:
+        async with session.request(
+            method,
+            url,
+            json=body,
+            params=params,
+            headers=self._headers(),
+            timeout=aiohttp.ClientTimeout(total=timeout or self._timeout),
+        ) as resp:
+            text = await resp.text()
+            if resp.status >= 400:
+                raise ControllerError(resp.status, _error_message(text))
+            return json.loads(text) if text.strip() else None
+
+    async def stream(self, path: str, params: Optional[Dict[str, str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Follow a streaming endpoint, which sends one JSON object per line until closed
+        """
+        resp = await self._connect(path, lambda session, url: session.get(
+            url,
+            params=params,
+            headers=self._headers(),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self._timeout),
+        ))
+        async with resp:
+            if resp.status >= 400:
+                raise ControllerError(resp.status, _error_message(await resp.text()))
+            async for line in resp.content:
+                if line.strip():
+                    yield json.loads(line)
+
+    async def websocket(self, path: str, params: Optional[Dict[str, str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Follow a websocket endpoint, which sends one JSON object per message until closed
+        """
+        ws = await self._connect(path, lambda session, url: session.ws_connect(
+            url,
+            params=params,
+            headers=self._headers(),
+            heartbeat=30,
+        ))
+        async with ws:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    yield json.loads(msg.data)
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    raise ws.exception() or aiohttp.ClientError("websocket error")
+
+    async def _connect(
+            self,
+            path: str,
+            connect: Callable[[aiohttp.ClientSession, str], Awaitable[T]],
+            transport: Optional[str] = None,
+            ) -> T:
+        """
+        Run connect through the unix socket, falling back to TCP when it cannot connect,
+        or only through transport when set
+        """
+        if transport is not None:
+            transports = [transport]
+        else:
+            transports = ["unix", "tcp"] if self._unix_available() else ["tcp"]
+        for candidate in transports[:-1]:
+            session, url = self._route(candidate, path)
+            try:
+                return await connect(session, url)
+            except aiohttp.ClientConnectorError as e:
+                # nothing was sent, e.g. a stale socket left by a dead core
+                logger.debug(f"controller: unix socket failed with {e}, falling back to TCP")
+        session, url = self._route(transports[-1], path)
+        return await connect(session, url)
+
+    def _unix_available(self) -> bool:
+        return self._unix_path is not None and os.path.exists(self._unix_path)
+
+    def _route(self, transport: str, path: str) -> Tuple[aiohttp.ClientSession, str]:
+        if transport == "unix":
+            if self._unix_path is None:
+                raise RuntimeError("controller unix socket is not configured")
+            key = self._unix_path
+        else:
+            if self._port is None:
+                raise RuntimeError("controller is not configured")
+            key = "tcp"
+        session = self._sessions.get(key)
+        if session is None or session.closed:
+            if transport == "unix":
+                connector = aiohttp.UnixConnector(path=key, limit=CONNECTION_LIMIT, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            else:
+                connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[key] = session
+        host = "localhost" if transport == "unix" else f"127.0.0.1:{self._port}"
+        return session, f"http://{host}{path}"
+
+    def _headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self._secret}"}
+
+    def _record(self, endpoint: str, latency: float, ok: bool) -> None:
+        m = self._metrics.setdefault(endpoint, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0, "last": 0.0})
+        m["count"] += 1
+        m["errors"] += 0 if ok else 1
+        m["total"] += latency
+        m["max"] = max(m["max"], latency)
+        m["last"] = latency
+        logger.debug(f"controller: {endpoint} {'ok' if ok else 'failed'} in {latency * 1000:.1f}ms")
+
+
+def _quote(name: str) -> str:
+    return urllib.parse.quote(name, safe="")
+
+
+def _error_message(text: str) -> str:
+    try:
+        return json.loads(text).get("message", text)
+    except (ValueError, AttributeError):
+        return text
@@ -1,29 +1,166 @@
 import asyncio
+from collections import deque, OrderedDict
+import hashlib
+import json
 import os
 from pathlib import Path
+import re
+import signal
 import subprocess
-from typing import Awaitable, Callable, Optional, List
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, List, Tuple
 
+import aiohttp
+
+import config
+from controller import ControllerClient, ControllerError
 import decky
 from decky import logger
+from proc_sampler import ResourceSampler
+import scheduling
 import utils
 
 LAST_CORE_VERSION = "1.19.25"
 
+CHECK_TIMEOUT = 60.0
+STATS_SIZE = 20
+# seconds between SIGTERM and SIGKILL
+STOP_GRACE = 5.0
+# reported as exit code of adopted cores, whose exit status is not available
+ADOPTED_RETURNCODE = -1
+
+# readiness polling backs off from the first interval to the last
+READY_POLL_MIN_INTERVAL = 0.02
+READY_POLL_MAX_INTERVAL = 0.1
+READY_POLL_TIMEOUT = 1.0
+
+_LOG_MSG_RE = re.compile(r'level=(?:error|fatal) msg="((?:[^"\\]|\\.)*)"')
+
 ExitCallback = Callable[[Optional[int]], Awaitable[None]]
+# (inode, size, mtime) of core binary, which changes whenever it is replaced
+BinaryIdentity = Tuple[int, int, int]
+Verdict = Tuple[bool, Optional[str]]
+
+class ValidationCache:
+    """
+    Persistent successful verdicts of `mihomo -t`, keyed by config content hash and core binary identity.
+    Least recently used entries are dropped beyond max_entries.
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self._path = path
+        self._max_entries = max_entries
+        self._entries: Optional[OrderedDict[str, Verdict]] = None
+
+    def get(self, key: str) -> Optional[Verdict]:
+        entries = self._load()
+        verdict = entries.get(key)
+        if verdict is not None:
+            entries.move_to_end(key)
+        return verdict
+
+    def put(self, key: str, verdict: Verdict) -> None:
+        entries = self._load()
+        entries[key] = verdict
+        entries.move_to_end(key)
+        while len(entries) > self._max_entries:
+            entries.popitem(last=False)
+        self._save()
+
+    def clear(self) -> None:
+        self._entries = OrderedDict()
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+    def _load(self) -> OrderedDict[str, Verdict]:
+        if self._entries is None:
+            self._entries = OrderedDict()
+            try:
+                with open(self._path) as f:
+                    for key, valid, error in json.load(f):
+                        self._entries[key] = (valid, error)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"validation_cache: failed to load {self._path}: {e}")
+        return self._entries
+
+    def _save(self) -> None:
+        assert self._entries is not None
+        try:
+            entries = [[key, valid, error] for key, (valid, error) in self._entries.items()]
+            utils.atomic_write(self._path, lambda f: json.dump(entries, f))
+        except Exception as e:
+            logger.warning(f"validation_cache: failed to save {self._path}: {e}")
+
+class AdoptedProcess:
+    """
+    Core started by a previous plugin instance, mimicking asyncio.subprocess.Process.
+    It is not our child, so exit is observed through a pidfd and the exit status is unknown.
+    """
+
+    def __init__(self, pid: int, pidfd: int):
+        self.pid = pid
+        self.returncode: Optional[int] = None
+        self._pidfd = pidfd
+        self._exited = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(pidfd, self._on_exit)
+
+    def _on_exit(self) -> None:
+        self._loop.remove_reader(self._pidfd)
+        os.close(self._pidfd)
+        self.returncode = ADOPTED_RETURNCODE
+        self._exited.set()
+
+    async def wait(self) -> int:
+        await self._exited.wait()
+        assert self.returncode is not None
+        return self.returncode
+
+    def send_signal(self, sig: int) -> None:
+        if self.returncode is not None:
+            raise ProcessLookupError(self.pid)
+        signal.pidfd_send_signal(self._pidfd, sig)
+
+    def terminate(self) -> None:
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
 
 class CoreController:
     BIN_NAME = "mihomo"
     CORE_PATH = os.path.join(decky.DECKY_PLUGIN_DIR, "bin", BIN_NAME)
     CONFIG_PATH = os.path.join(decky.DECKY_PLUGIN_RUNTIME_DIR, "running_config.yaml")
     RESOURCE_DIR = decky.DECKY_PLUGIN_RUNTIME_DIR
+    PID_PATH = os.path.join(decky.DECKY_PLUGIN_RUNTIME_DIR, "core.pid")
+    CONTROLLER_SOCKET = os.path.join(decky.DECKY_PLUGIN_RUNTIME_DIR, "controller.sock")
+    LOG_PATH = os.path.join(decky.DECKY_PLUGIN_LOG_DIR, "core.log")
+
+    # `mihomo -t` loads geodata and compiles rules, which keeps one cpu busy per run
+    _check_semaphore = asyncio.Semaphore(os.cpu_count() or 1)
+    _validation_cache = ValidationCache(
+        os.path.join(decky.DECKY_PLUGIN_RUNTIME_DIR, "validation_cache.json"), 64)
+    _version_cache: Optional[Tuple[BinaryIdentity, str]] = None
 
-    def __init__(self):
+    def __init__(self, stop_grace: float = STOP_GRACE):
 
-        self._process: Optional[asyncio.subprocess.Process] = None
+        self._stop_grace = stop_grace
+        self._process: Optional[asyncio.subprocess.Process | AdoptedProcess] = None
+        self._logfile = None
         self._command: List[str] = []
         self._exit_callback: Optional[ExitCallback] = None
         self._monitor_task: Optional[asyncio.Task] = None
+        self.controller = ControllerClient()
+        self._startup_stats: Deque[Dict[str, Any]] = deque(maxlen=STATS_SIZE)
+        self._stop_stats: Deque[Dict[str, Any]] = deque(maxlen=STATS_SIZE)
+        self.sampler = ResourceSampler(self._running_pid)
+        self._scheduling: scheduling.SchedulingProfile = {}
+        # generation key and section digests of the running config core has loaded
+        self._loaded_config: Dict[str, Any] = {}
 
     @property
     def is_running(self) -> bool:
@@ -33,6 +170,10 @@ class CoreController:
             return True
         return False
 
+    @property
+    def loaded_config(self) -> Dict[str, Any]:
+        return dict(self._loaded_config)
+
     @classmethod
     def _gen_cmd(cls, config_path: str) -> List[str]:
         return [
@@ -43,18 +184,55 @@ class CoreController:
             cls.RESOURCE_DIR,
         ]
 
-    async def start(self) -> None:
+    def _running_pid(self) -> Optional[int]:
+        return self._process.pid if self._process is not None and self._process.returncode is None else None
+
+    def configure_controller(self, port: int, secret: str, unix: bool = False) -> None:
+        self.controller.configure(port, secret, self.CONTROLLER_SOCKET if unix else None)
+
+    def configure_scheduling(self, profile: scheduling.SchedulingProfile) -> None:
+        """
+        Set scheduling profile applied to cores started afterwards
+        """
+        self._scheduling = profile
+
+    def get_scheduling(self) -> Dict[str, Any]:
+        pid = self._running_pid()
+        return {
+            "profile": self._scheduling,
+            "applied": scheduling.read_back(pid) if pid is not None else None,
+        }
+
+    def get_startup_stats(self) -> List[Dict[str, Any]]:
+        return list(self._startup_stats)
+
+    def get_stop_stats(self) -> List[Dict[str, Any]]:
+        return list(self._stop_stats)
+
+    async def start(self, wait_ready: bool = False, deadline: Optional[float] = None, label: str = "") -> bool:
+        """
+        Start core
+        Args:
+            wait_ready: Wait until external controller answers
+            deadline: Seconds to wait for readiness after spawning, None for no limit
+            label: Recorded with startup stats, e.g. the current subscription
+        Returns:
+            bool: Whether core is ready, always True when not waiting
+        Raises:
+            RuntimeError: When core exits before it is ready
+        """
         if self._process and self._process.returncode is None:
             logger.warning("core is already running")
-            return
+            return True
 
-        command = self._gen_cmd(self.CONFIG_PATH)
+        command = scheduling.scope_command(self._scheduling) + self._gen_cmd(self.CONFIG_PATH)
         logger.info(f"starting core: {' '.join(command)}")
         self._command = command
 
-        log_path = os.path.join(decky.DECKY_PLUGIN_LOG_DIR, "core.log")
-        logger.info(f"core log file: {log_path}")
-        self._logfile = open(log_path, 'w')
+        begin = time.monotonic()
+        logger.info(f"core log file: {self.LOG_PATH}")
+        # appending keeps writes safe while the plugin truncates the file for rotation
+        self._logfile = open(self.LOG_PATH, 'a')
 
         try:
             self._process = await asyncio.create_subprocess_exec(
@@ -62,45 +240,242 @@ class CoreController:
                 stdout=self._logfile,
                 stderr=self._logfile,
                 env=utils.env_fix(),
+                preexec_fn=scheduling.preexec(self._scheduling),
             )
             logger.debug(f"core pid: {self._process.pid}")
+            logger.debug(f"core scheduling: {scheduling.read_back(self._process.pid)}")
             self._monitor_task = asyncio.create_task(self._monitor_exit())
+            self.record_config()
         except Exception as e:
             logger.error(f"failed to start core: {str(e)}")
             self._logfile.close()
             self._logfile = None
             raise
 
+        if not wait_ready:
+            return True
+        ready = await self._wait_ready(self._process, begin, deadline)
+        latency = time.monotonic() - begin
+        self._startup_stats.append({
+            'time': time.time(),
+            'version': LAST_CORE_VERSION,
+            'label': label,
+            'ready': ready,
+            'latency': latency,
+        })
+        if ready:
+            logger.info(f"core ready in {latency:.3f}s")
+        else:
+            logger.warning(f"core not ready after {latency:.3f}s")
+        return ready
+
+    async def _wait_ready(self, process: asyncio.subprocess.Process, begin: float, deadline: Optional[float]) -> bool:
+        if not self.controller.is_configured:
+            logger.warning("_wait_ready: controller not configured")
+            return False
+        interval = READY_POLL_MIN_INTERVAL
+        while True:
+            if process.returncode is not None:
+                raise RuntimeError(f"core exited with code {process.returncode} before ready")
+            try:
+                await self.controller.version(timeout=READY_POLL_TIMEOUT)
+                return True
+            except ControllerError as e:
+                logger.debug(f"_wait_ready: {e}")
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            if deadline is not None:
+                remaining = begin + deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                interval = min(interval, remaining)
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, READY_POLL_MAX_INTERVAL)
+
     async def stop(self) -> None:
-        if not self._process or self._process.returncode is not None:
+        """
+        Stop core, terminating it first and killing it when it outlives the grace period
+        """
+        process = self._process
+        if not process or process.returncode is not None:
             logger.warning("no running core")
             return
 
-        logger.info(f"terminating core (PID: {self._process.pid})")
+        logger.info(f"terminating core (PID: {process.pid})")
+        begin = time.monotonic()
         if self._monitor_task is not None:
             self._monitor_task.cancel()
             self._monitor_task = None
+        method = "terminate"
         try:
-            self._process.terminate()
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), self._stop_grace)
+            except asyncio.TimeoutError:
+                logger.warning(f"core still running after {self._stop_grace}s, killing")
+                method = "kill"
+                process.kill()
+                await process.wait()
+        except ProcessLookupError:
+            await process.wait()
         except Exception as e:
             logger.error(f"failed to terminate core with error: {e}")
+            method = "pkill"
             self.kill()
         finally:
             self._process = None
-            logger.debug("core terminated")
+            self._remove_pidfile(process.pid)
             if self._logfile:
                 self._logfile.close()
                 self._logfile = None
+        latency = time.monotonic() - begin
+        self._stop_stats.append({
+            'time': time.time(),
+            'method': method,
+            'returncode': process.returncode,
+            'latency': latency,
+        })
+        logger.info(f"core stopped by {method} in {latency:.3f}s")
 
-    async def restart(self) -> None:
+    async def restart(self, wait_ready: bool = False, deadline: Optional[float] = None, label: str = "") -> bool:
         logger.info("restarting core ...")
+        begin = time.monotonic()
         await self.stop()
-        await self.start()
+        stopped = time.monotonic()
+        ready = await self.start(wait_ready, deadline, label)
+        logger.info(f"core restarted in {time.monotonic() - begin:.3f}s (stop {stopped - begin:.3f}s)")
+        return ready
+
+    def record_config(self) -> None:
+        """
+        Record running core and the running config it has applied, for adoption by the next plugin instance
+        """
+        process = self._process
+        if process is None or process.returncode is not None:
+            return
+        try:
+            starttime = _proc_starttime(process.pid)
+            with open(self.CONFIG_PATH, 'rb') as f:
+                digest = hashlib.file_digest(f, 'sha256').hexdigest()
+            self._loaded_config = {
+                'key': config.get_generation_key(self.CONFIG_PATH),
+                'sections': config.get_section_digests(self.CONFIG_PATH),
+            }
+            record = {'pid': process.pid, 'starttime': starttime, 'config': digest, **self._loaded_config}
+            utils.atomic_write(self.PID_PATH, lambda f: json.dump(record, f))
+        except Exception as e:
+            logger.warning(f"record_config: failed to write {self.PID_PATH}: {e}")
+
+    async def adopt(self) -> bool:
+        """
+        Take over a core left running by a previous plugin instance
+        Returns:
+            bool: Whether a core started from current running config was adopted.
+                A previous core running another config is stopped.
+        """
+        if self.is_running:
+            return False
+        record = self._read_pidfile()
+        if record is None:
+            return False
+        pidfd = self._open_pidfd(record)
+        if pidfd is None:
+            self._remove_pidfile(record['pid'])
+            return False
+
+        self._process = AdoptedProcess(record['pid'], pidfd)
+        self._monitor_task = asyncio.create_task(self._monitor_exit())
+        if not self._same_binary(record['pid']):
+            # e.g. left by a plugin installed elsewhere, it would collide with a new core on TUN and ports
+            logger.info(f"adopt: core (PID: {record['pid']}) runs another binary, stopping")
+            await self.stop()
+            return False
+        try:
+            with open(self.CONFIG_PATH, 'rb') as f:
+                matched = hashlib.file_digest(f, 'sha256').hexdigest() == record.get('config')
+        except OSError:
+            matched = False
+        if not matched:
+            logger.info(f"adopt: core (PID: {record['pid']}) runs another config, stopping")
+            await self.stop()
+            return False
+        self._loaded_config = {'key': record.get('key'), 'sections': record.get('sections')}
+        logger.info(f"adopt: adopted core (PID: {record['pid']})")
+        return True
+
+    def detach(self) -> None:
+        """
+        Stop tracking core and leave it running for the next plugin instance
+        """
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            self._monitor_task = None
+        if self._process is not None:
+            logger.info(f"detaching core (PID: {self._process.pid})")
+        self._process = None
+        if self._logfile:
+            self._logfile.close()
+            self._logfile = None
+
+    @classmethod
+    def _read_pidfile(cls) -> Optional[Dict[str, Any]]:
+        try:
+            with open(cls.PID_PATH) as f:
+                record = json.load(f)
+            if isinstance(record.get('pid'), int) and isinstance(record.get('starttime'), int):
+                return record
+            logger.warning(f"invalid pidfile: {record}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"failed to read {cls.PID_PATH}: {e}")
+        return None
+
+    @classmethod
+    def _remove_pidfile(cls, pid: int) -> None:
+        record = cls._read_pidfile()
+        if record is None or record['pid'] != pid:
+            return
+        try:
+            os.remove(cls.PID_PATH)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def _open_pidfd(cls, record: Dict[str, Any]) -> Optional[int]:
+        """
+        Open a pidfd of recorded core, verifying it is still the same process
+        """
+        pid = record['pid']
+        try:
+            pidfd = os.pidfd_open(pid)
+        except (ProcessLookupError, OSError):
+            return None
+        try:
+            # checked after opening, so the pidfd can not refer to a reused pid
+            if _proc_starttime(pid) == record['starttime']:
+                return pidfd
+            logger.debug(f"pid {pid} is no longer the recorded core")
+        except OSError:
+            pass
+        os.close(pidfd)
+        return None
+
+    @classmethod
+    def _same_binary(cls, pid: int) -> bool:
+        try:
+            exe = os.readlink(f"/proc/{pid}/exe")
+        except OSError:
+            return False
+        # the binary is replaced in place by core and plugin upgrades
+        return exe.removesuffix(" (deleted)") == os.path.realpath(cls.CORE_PATH)
 
     async def _monitor_exit(self):
-        assert self._process is not None
-        returncode = await self._process.wait()
+        process = self._process
+        assert process is not None
+        returncode = await process.wait()
         logger.debug(f"core exited with code: {returncode}")
+        self._remove_pidfile(process.pid)
 
         if self._exit_callback is not None:
             try:
@@ -112,26 +487,97 @@ class CoreController:
         self._exit_callback = callback
 
     @classmethod
-    def check_config(cls, config_path: str) -> bool:
+    async def check_config(cls, config_path: str, timeout: Optional[float] = CHECK_TIMEOUT) -> Tuple[bool, Optional[str]]:
+        """
+        Validate config with `mihomo -t`
+        Args:
+            config_path: Config to validate
+            timeout: Timeout of a single run, not including waiting for other runs
+        Returns:
+            tuple(bool, Optional[str])
+            bool: Whether config is valid
+            Optional[str]: Error message reported by core
+        """
+        key = await asyncio.to_thread(cls._validation_key, config_path)
+        verdict = cls._validation_cache.get(key) if key is not None else None
+        if verdict is not None:
+            logger.debug(f"check_config: cached verdict for {config_path}: {verdict}")
+            return verdict
+
         command = cls._gen_cmd(config_path)
         command.append("-t")
-        logger.debug(f"check_config: {' '.join(command)}")
+        async with cls._check_semaphore:
+            logger.debug(f"check_config: {' '.join(command)}")
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                env=utils.env_fix(),
+            )
+            try:
+                output, _ = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"check_config: timed out after {timeout}s")
+                return False, f"Config check timed out after {timeout}s"
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
+        logger.debug(f"check_config: return code: {process.returncode}")
+        if process.returncode == 0:
+            verdict = True, None
+        else:
+            error = _check_error(output.decode(errors='replace'))
+            logger.error(f"check_config: {error}")
+            verdict = False, error
+        # failures may come from outside the config, e.g. missing geodata, and are checked again next time
+        if key is not None and verdict[0]:
+            cls._validation_cache.put(key, verdict)
+        return verdict
 
+    @classmethod
+    def clear_validation_cache(cls) -> None:
+        cls._validation_cache.clear()
+
+    @classmethod
+    def binary_identity(cls) -> Optional[BinaryIdentity]:
         try:
-            return_code = subprocess.call(command)
-        except Exception as e:
-            logger.error(f"failed to start core: {e}")
-            raise
+            st = os.stat(cls.CORE_PATH)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
 
-        logger.debug(f"check_config: return code: {return_code}")
-        return return_code == 0
+    @classmethod
+    def _validation_key(cls, config_path: str) -> Optional[str]:
+        identity = cls.binary_identity()
+        if identity is None:
+            return None
+        try:
+            with open(config_path, 'rb') as f:
+                digest = hashlib.file_digest(f, 'sha256').hexdigest()
+        except OSError:
+            return None
+        return f"{digest}-{'-'.join(map(str, identity))}"
 
     @classmethod
-    def get_version(cls) -> str:
+    async def get_version(cls) -> str:
+        identity = cls.binary_identity()
+        if identity is None:
+            logger.error(f"get_version: core not found at {cls.CORE_PATH}")
+            return ""
+        if cls._version_cache is not None and cls._version_cache[0] == identity:
+            return cls._version_cache[1]
+
         try:
             cmd = [ cls.CORE_PATH, "-v" ]
             logger.debug(f"get_version: cmd: {' '.join(cmd)}")
-            output = subprocess.check_output(cmd)
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                env=utils.env_fix(),
+            )
+            output, _ = await process.communicate()
         except Exception as e:
             logger.error(f"get_version: failed to start core: {str(e)}")
             return ""
@@ -141,11 +587,30 @@ class CoreController:
             if s.startswith("v") or s.startswith("alpha-"):
                 global LAST_CORE_VERSION
                 LAST_CORE_VERSION = s.strip()
+                cls._version_cache = identity, LAST_CORE_VERSION
                 return LAST_CORE_VERSION
         return ""
 
+    @classmethod
+    def invalidate_version(cls) -> None:
+        cls._version_cache = None
+
     @classmethod
     def kill(cls, timeout: Optional[float] = None) -> bool:
+        record = cls._read_pidfile()
+        pidfd = cls._open_pidfd(record) if record is not None else None
+        if pidfd is not None:
+            logger.debug(f"killing core by pid: {record['pid']}")
+            try:
+                signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+                return True
+            except ProcessLookupError:
+                return True
+            except Exception as e:
+                logger.error(f"kill core: failed to kill pid {record['pid']} with {e}")
+            finally:
+                os.close(pidfd)
+
         logger.debug(f"killing core by process name: {cls.BIN_NAME}")
 
         try:
@@ -169,3 +634,16 @@ class CoreController:
             result.stderr.strip(),
         )
         return False
+
+def _check_error(output: str) -> str:
+    matches = _LOG_MSG_RE.findall(output)
+    if matches:
+        return matches[-1].replace('\\"', '"')
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    return lines[-1] if lines else "Invalid config"
+
+def _proc_starttime(pid: int) -> int:
+    with open(f"/proc/{pid}/stat") as f:
+        stat = f.read()
+    # fields after comm, which may contain spaces, starttime is field 22
+    return int(stat.rsplit(')', 1)[1].split()[19])
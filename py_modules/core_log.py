@@ -0,0 +1,172 @@
+import asyncio
+from collections import deque
+import os
+import re
+import shutil
+from typing import Deque, Iterator, List, Optional
+
+from decky import logger
+
+# logrus levels written by mihomo, in increasing severity
+LEVELS = ["trace", "debug", "info", "warning", "error", "fatal", "panic"]
+
+_LEVEL_RE = re.compile(r'\blevel=(\w+)')
+
+# the follower polls faster while the core is logging and backs off when idle
+_POLL_MIN_INTERVAL = 0.25
+_POLL_MAX_INTERVAL = 2.0
+_READ_SIZE = 64 * 1024
+
+
+class CoreLog:
+    """
+    Follower of core log file, keeping the latest lines in memory and rotating the file by size.
+    Core writes the file directly with O_APPEND, so it survives the plugin exiting, and the file
+    is rotated by copy and truncate.
+    """
+
+    def __init__(self, path: str, max_bytes: int, backups: int, max_lines: int = 1000):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._lines: Deque[str] = deque(maxlen=max_lines)
+        self._partial = b''
+        self._position = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._seed()
+        self._task = asyncio.create_task(self._follow())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def tail(self, n: int) -> List[str]:
+        if n <= 0:
+            return []
+        return list(self._lines)[-n:]
+
+    def search(self, level: Optional[str] = None, pattern: Optional[str] = None, limit: int = 200) -> List[str]:
+        """
+        Search log files line by line, from the oldest rotated file to the current one
+        Args:
+            level: Minimum level of matched lines
+            pattern: Regular expression matched lines contain
+            limit: Maximum number of lines returned, the latest are kept
+        Raises:
+            ValueError: When level or pattern is invalid
+        """
+        min_level = self._level_index(level) if level else None
+        try:
+            regex = re.compile(pattern) if pattern else None
+        except re.error as e:
+            raise ValueError(f"invalid pattern: {e}")
+        matches: Deque[str] = deque(maxlen=limit)
+        for line in self._iter_files():
+            if regex is not None and regex.search(line) is None:
+                continue
+            if min_level is not None:
+                m = _LEVEL_RE.search(line)
+                if m is None or m.group(1) not in LEVELS or LEVELS.index(m.group(1)) < min_level:
+                    continue
+            matches.append(line)
+        return list(matches)
+
+    def _iter_files(self) -> Iterator[str]:
+        paths = [f"{self._path}.{i}" for i in range(self._backups, 0, -1)] + [self._path]
+        for path in paths:
+            try:
+                with open(path, encoding='utf-8', errors='replace') as f:
+                    for line in f:
+                        yield line.rstrip('\n')
+            except FileNotFoundError:
+                continue
+
+    @staticmethod
+    def _level_index(level: str) -> int:
+        if level not in LEVELS:
+            raise ValueError(f"invalid level: {level}")
+        return LEVELS.index(level)
+
+    def _seed(self) -> None:
+        try:
+            with open(self._path, 'rb') as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(0, size - _READ_SIZE))
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if size > _READ_SIZE:
+            # drop the line cut by the seek
+            data = data.partition(b'\n')[2]
+        self._position = size
+        self._feed(data)
+
+    def _feed(self, data: bytes) -> None:
+        data = self._partial + data
+        *lines, self._partial = data.split(b'\n')
+        self._lines.extend(line.decode('utf-8', errors='replace') for line in lines)
+
+    async def _follow(self) -> None:
+        interval = _POLL_MIN_INTERVAL
+        failing = False
+        while True:
+            try:
+                grew = await asyncio.to_thread(self._poll)
+                if failing:
+                    logger.info(f"core_log: following {self._path} again")
+                    failing = False
+            except Exception as e:
+                # reported once per streak, polling goes on every interval
+                if failing:
+                    logger.debug(f"core_log: failed to follow {self._path}: {e}")
+                else:
+                    logger.error(f"core_log: failed to follow {self._path}: {e}")
+                    failing = True
+                grew = False
+            interval = _POLL_MIN_INTERVAL if grew else min(interval * 2, _POLL_MAX_INTERVAL)
+            await asyncio.sleep(interval)
+
+    def _poll(self) -> bool:
+        try:
+            size = os.stat(self._path).st_size
+        except FileNotFoundError:
+            return False
+        if size < self._position:
+            # truncated by someone else
+            self._position = 0
+            self._partial = b''
+        if size == self._position:
+            return False
+        with open(self._path, 'rb') as f:
+            f.seek(self._position)
+            while True:
+                data = f.read(_READ_SIZE)
+                if not data:
+                    break
+                self._position += len(data)
+                self._feed(data)
+        if self._position > self._max_bytes:
+            self._rotate()
+        return True
+
+    def _rotate(self) -> None:
+        logger.debug(f"core_log: rotating {self._path}")
+        if self._backups > 0:
+            for i in range(self._backups - 1, 0, -1):
+                if os.path.exists(f"{self._path}.{i}"):
+                    os.replace(f"{self._path}.{i}", f"{self._path}.{i + 1}")
+            shutil.copyfile(self._path, f"{self._path}.1")
+        # lines written between copying and truncating are lost, as with logrotate's copytruncate
+        os.truncate(self._path, 0)
+        self._position = 0
+        self._partial = b''
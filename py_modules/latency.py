@@ -0,0 +1,351 @@
+import asyncio
+import json
+import math
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from controller import ControllerClient, ControllerError
+import decky
+from decky import logger
+from ring_buffer import RingBuffer
+import utils
+
+HISTORY_PATH = os.path.join(decky.DECKY_PLUGIN_RUNTIME_DIR, "latency_history.json")
+HISTORY_FIELDS = ['time', 'delay']
+# proxies without samples for this long are dropped from history
+HISTORY_MAX_AGE = 7 * 24 * 3600
+EWMA_ALPHA = 0.3
+# a proxy losing every other test scores as if twice as slow plus its delay
+LOSS_PENALTY = 2.0
+# samples a proxy needs before the selector switches to it
+MIN_SAMPLES = 3
+
+# proxy types a delay test means nothing for
+_SKIP_TYPES = {"Direct", "Reject", "RejectDrop", "Pass", "Compatible"}
+# controller answers a delay test with these when the proxy failed or timed out,
+# anything else says nothing about the proxy
+PROXY_FAILURE_STATUSES = {503, 504}
+# partial results are batched into one event per interval
+EMIT_INTERVAL = 0.2
+
+# delay in ms, None when the proxy failed the test
+Delays = Dict[str, Optional[int]]
+EmitCallback = Callable[[Delays], Awaitable[Any]]
+
+
+def group_members(proxies: Dict[str, Any], group: Optional[str]) -> List[str]:
+    """
+    Testable members of a group, or of all groups when group is None
+    Raises:
+        KeyError: When group does not exist
+    """
+    groups = [proxies[group]] if group is not None else [p for p in proxies.values() if "all" in p]
+    names = dict.fromkeys(name for g in groups for name in g["all"])
+    return [name for name in names if proxies.get(name, {}).get("type") not in _SKIP_TYPES]
+
+
+def score(stats: Optional[Dict[str, Any]]) -> float:
+    """
+    Lower is better, infinite for proxies without a successful test
+    """
+    if stats is None or stats["ewma"] is None:
+        return math.inf
+    return stats["ewma"] * (1 + LOSS_PENALTY * stats["loss"])
+
+
+class LatencyHistory:
+    """
+    Latest delay samples of each proxy, one ring buffer per proxy with failures stored as missing delays.
+    """
+
+    def __init__(self, path: str, capacity: int):
+        self._path = path
+        self._capacity = capacity
+        self._buffers: Dict[str, RingBuffer] = {}
+        self._dirty = False
+
+    def add(self, name: str, delay: Optional[int]) -> None:
+        buffer = self._buffers.get(name)
+        if buffer is None:
+            buffer = self._buffers[name] = RingBuffer(self._capacity, HISTORY_FIELDS)
+        buffer.append({'time': time.time(), 'delay': delay})
+        self._dirty = True
+
+    def stats(self, name: str) -> Optional[Dict[str, Any]]:
+        """
+        Summary of a proxy's samples
+        Returns:
+            Optional[Dict[str, Any]]: samples, last, ewma, p50, p95 and loss, None when never tested
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None or len(buffer) == 0:
+            return None
+        delays = buffer.series('delay')
+        ok = [d for d in delays if d is not None]
+        ewma = None
+        for d in ok:
+            ewma = d if ewma is None else EWMA_ALPHA * d + (1 - EWMA_ALPHA) * ewma
+        ok.sort()
+        return {
+            "samples": len(delays),
+            "last": delays[-1],
+            "ewma": ewma,
+            "p50": _percentile(ok, 50),
+            "p95": _percentile(ok, 95),
+            "loss": (len(delays) - len(ok)) / len(delays),
+        }
+
+    def all_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: stats for name in self._buffers if (stats := self.stats(name)) is not None}
+
+    def load(self) -> None:
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"latency_history: failed to load {self._path}: {e}")
+            return
+        for name, series in data.items():
+            buffer = self._buffers[name] = RingBuffer(self._capacity, HISTORY_FIELDS)
+            for t, delay in zip(series['time'], series['delay']):
+                buffer.append({'time': t, 'delay': delay})
+
+    async def save(self) -> None:
+        if not self._dirty:
+            return
+        self._dirty = False
+        expired = time.time() - HISTORY_MAX_AGE
+        for name in [name for name, buffer in self._buffers.items() if buffer.latest()['time'] < expired]:
+            del self._buffers[name]
+        data = {name: {field: buffer.series(field) for field in HISTORY_FIELDS} for name, buffer in self._buffers.items()}
+        await asyncio.to_thread(self._write, data)
+
+    def _write(self, data: Dict[str, Any]) -> None:
+        try:
+            utils.atomic_write(self._path, lambda f: json.dump(data, f))
+        except Exception as e:
+            logger.warning(f"latency_history: failed to save {self._path}: {e}")
+
+
+class LatencyTester:
+    """
+    Delay tests of proxies through controller, run under a concurrency limit and a global deadline.
+    Results, including failures, are cached for ttl seconds, and a proxy being tested is not tested twice.
+    """
+
+    def __init__(self, client: ControllerClient, emit: EmitCallback, history: Optional[LatencyHistory] = None):
+        self._client = client
+        self._emit = emit
+        self._history = history
+        # (proxy, url) => (monotonic time, delay)
+        self._cache: Dict[Tuple[str, str], Tuple[float, Optional[int]]] = {}
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        # callers awaiting each inflight test, which is cancelled once none is left
+        self._waiters: Dict[Tuple[str, str], int] = {}
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    async def test(
+            self,
+            group: Optional[str],
+            url: str,
+            timeout_ms: int,
+            concurrency: int,
+            deadline: float,
+            ttl: float,
+            force: bool = False,
+            ) -> Delays:
+        """
+        Test proxies of a group, or of all groups
+        Args:
+            group: Group name, all groups when None
+            url: URL requested through each proxy
+            timeout_ms: Timeout of a single test
+            concurrency: Maximum number of tests running at once
+            deadline: Seconds after which unfinished tests are cancelled
+            ttl: Seconds cached results stay valid
+            force: Ignore cached results
+        Returns:
+            Delays: Delay of each tested proxy, proxies not finished before deadline
+                or not tested because controller was unavailable are absent
+        Raises:
+            KeyError: When group does not exist
+        """
+        names = group_members(await self._client.proxies(), group)
+        now = time.monotonic()
+        results: Delays = {}
+        pending: List[str] = []
+        for name in names:
+            cached = self._cache.get((name, url))
+            if not force and cached is not None and now - cached[0] < ttl:
+                results[name] = cached[1]
+            else:
+                pending.append(name)
+        logger.debug(f"latency: {len(results)} cached, testing {len(pending)} of {len(names)}")
+        if results:
+            await self._emit(dict(results))
+        if not pending:
+            return results
+
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        batch: Delays = {}
+        tasks = {asyncio.ensure_future(self._test_shared(name, url, timeout_ms, semaphore)): name for name in pending}
+        begin = time.monotonic()
+        waiting = set(tasks)
+        unavailable = 0
+        try:
+            while waiting:
+                remaining = begin + deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, waiting = await asyncio.wait(waiting, timeout=min(EMIT_INTERVAL, remaining))
+                for task in done:
+                    try:
+                        batch[tasks[task]] = task.result()
+                    except (ControllerError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        logger.debug(f"latency: {tasks[task]} not tested: {e}")
+                        unavailable += 1
+                if batch:
+                    results.update(batch)
+                    await self._emit(batch)
+                    batch = {}
+        finally:
+            for task in waiting:
+                task.cancel()
+        if waiting:
+            logger.warning(f"latency: {len(waiting)} tests unfinished after {deadline}s")
+        if unavailable:
+            logger.warning(f"latency: {unavailable} tests not run, controller unavailable")
+        if self._history is not None:
+            await self._history.save()
+        return results
+
+    async def _test_shared(self, name: str, url: str, timeout_ms: int, semaphore: asyncio.Semaphore) -> Optional[int]:
+        key = (name, url)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._test_one(name, url, timeout_ms, semaphore))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # a caller hitting its deadline must not cancel the test another caller waits for
+            return await asyncio.shield(future)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                if not future.done():
+                    future.cancel()
+
+    async def _test_one(self, name: str, url: str, timeout_ms: int, semaphore: asyncio.Semaphore) -> Optional[int]:
+        """
+        Raises:
+            ControllerError: When controller rejects the test, e.g. for an unknown proxy
+            aiohttp.ClientError: When controller is unreachable
+            asyncio.TimeoutError: When controller does not answer in time
+        """
+        async with semaphore:
+            try:
+                delay: Optional[int] = await self._client.proxy_delay(name, url, timeout_ms)
+            except ControllerError as e:
+                if e.status not in PROXY_FAILURE_STATUSES:
+                    raise
+                logger.debug(f"latency: {name} failed with {e}")
+                delay = None
+        self._cache[(name, url)] = (time.monotonic(), delay)
+        if self._history is not None:
+            self._history.add(name, delay)
+        return delay
+
+
+class AutoSelector:
+    """
+    Background selector switching a select group to its best member, tested every interval while core runs.
+    The current member is kept until its score is worse than the best one's by more than hysteresis,
+    and the choice survives core restarts through profile.store-selected.
+    """
+
+    def __init__(
+            self,
+            client: ControllerClient,
+            history: LatencyHistory,
+            test: Callable[[str], Awaitable[Delays]],
+            is_running: Callable[[], bool],
+            group: str,
+            interval: float,
+            hysteresis: float,
+            ):
+        self._client = client
+        self._history = history
+        self._test = test
+        self._is_running = is_running
+        self._group = group
+        self._interval = interval
+        self._hysteresis = hysteresis
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            if not self._is_running():
+                continue
+            try:
+                await self.select()
+            except Exception as e:
+                logger.error(f"auto_selector: failed with {e}")
+
+    async def select(self) -> Optional[str]:
+        """
+        Test the group and switch it when its current member has degraded
+        Returns:
+            Optional[str]: Member switched to, None when unchanged
+        """
+        await self._test(self._group)
+        proxies = await self._client.proxies()
+        group = proxies[self._group]
+        if group.get("type") != "Selector":
+            logger.warning(f"auto_selector: {self._group} is a {group.get('type')} group, not a select group")
+            return None
+        current = group.get("now")
+        candidates = {}
+        for name in group_members(proxies, self._group):
+            stats = self._history.stats(name)
+            if stats is not None and stats["samples"] >= MIN_SAMPLES:
+                candidates[name] = score(stats)
+        if not candidates:
+            return None
+        best = min(candidates, key=candidates.__getitem__)
+        current_score = score(self._history.stats(current)) if current else math.inf
+        if best == current or current_score <= candidates[best] * (1 + self._hysteresis):
+            return None
+        await self._client.select_proxy(self._group, best)
+        logger.info(f"auto_selector: {self._group} switched from {current} ({current_score:.0f}) to {best} ({candidates[best]:.0f})")
+        return best
+
+
+def _percentile(values: List[float], p: int) -> Optional[float]:
+    # nearest rank of sorted values
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
@@ -0,0 +1,236 @@
+from collections import OrderedDict
+import json
+import os
+import shutil
+import stat
+import threading
+from typing import Any, Callable, Optional, Tuple
+
+import decky
+from decky import logger
+import ruamel.yaml
+from ruamel.yaml.scalarbool import ScalarBoolean
+import utils
+
+# under runtime dir, which backup and restore never touch
+CACHE_DIR = os.path.join(decky.DECKY_PLUGIN_RUNTIME_DIR, "parse_cache")
+# location of pickled caches of previous versions
+LEGACY_CACHE_DIR = os.path.join(decky.DECKY_PLUGIN_SETTINGS_DIR, "subscriptions_cache")
+
+# parsed trees take roughly this many times the size of their source text
+_EXPANSION_RATIO = 30
+
+StatKey = Tuple[int, int, int]
+EntryKey = Tuple[str, str]
+
+
+def stat_key(path: str) -> StatKey:
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class ParseCache:
+    """
+    Bounded LRU of parsed subscription trees, keyed by path and loader tag,
+    invalidated by (mtime, size, inode). Trees are handed out as top-level copies, so
+    callers may replace top-level keys but must not mutate nested values.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._used_bytes = 0
+        self._entries: OrderedDict[EntryKey, Tuple[StatKey, int, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_budget(self, max_bytes: int) -> None:
+        with self._lock:
+            self._max_bytes = max_bytes
+            while self._entries and self._used_bytes > self._max_bytes:
+                _, (_, evicted_cost, _) = self._entries.popitem(last=False)
+                self._used_bytes -= evicted_cost
+
+    def get(self, path: str, key: StatKey, tag: str = '') -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get((path, tag))
+            if entry is None:
+                return None
+            if entry[0] != key:
+                self._drop((path, tag))
+                return None
+            self._entries.move_to_end((path, tag))
+            return entry[2].copy()
+
+    def put(self, path: str, key: StatKey, tree: Any, tag: str = '') -> None:
+        cost = key[1] * _EXPANSION_RATIO
+        with self._lock:
+            self._drop((path, tag))
+            if cost > self._max_bytes:
+                logger.debug(f"parse_cache: {path} exceeds budget, not cached")
+                return
+            while self._entries and self._used_bytes + cost > self._max_bytes:
+                evicted, (_, evicted_cost, _) = self._entries.popitem(last=False)
+                self._used_bytes -= evicted_cost
+                logger.debug(f"parse_cache: evicted {evicted}")
+            self._entries[(path, tag)] = (key, cost, tree)
+            self._used_bytes += cost
+
+    def load(
+            self,
+            path: str,
+            loader: Callable[[bytes], Any],
+            data: Optional[bytes] = None,
+            key: Optional[StatKey] = None,
+            tag: str = '',
+            ) -> Any:
+        # stat before reading, so a concurrent replace can never be cached under the new key
+        if key is None:
+            key = stat_key(path)
+        tree = self.get(path, key, tag)
+        if tree is not None:
+            logger.debug(f"parse_cache: hit {path}")
+            return tree
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        tree = loader(data)
+        self.put(path, key, tree, tag)
+        return tree.copy()
+
+    def invalidate(self, path: str) -> None:
+        with self._lock:
+            for entry_key in [k for k in self._entries if k[0] == path]:
+                self._drop(entry_key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._used_bytes = 0
+
+    def _drop(self, entry_key: EntryKey) -> None:
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self._used_bytes -= entry[1]
+
+
+class DiskCache:
+    """
+    Persistent parse results as JSON, one directory per subscription file.
+    Entries are keyed by content hash, vendored ruamel version and loader tag,
+    only entries of the latest content of each subscription are kept.
+    Trees are converted to plain JSON types, dropping what round-trip trees keep of formatting,
+    so it only serves callers that do not emit YAML from round-trip trees.
+    The cache directory is used only when it is private to the plugin's user.
+    """
+
+    def __init__(self, directory: str):
+        self._directory = directory
+
+    def load(
+            self,
+            path: str,
+            digest: str,
+            data: bytes,
+            loader: Callable[[bytes], Any],
+            tag: str = '',
+            ) -> Any:
+        if not self._ensure_private():
+            return loader(data)
+        entry_dir = self._entry_dir(path)
+        suffix = f"-{tag}" if tag else ""
+        entry_path = os.path.join(entry_dir, f"{digest}-{ruamel.yaml.__version__}{suffix}.json")
+        try:
+            with open(entry_path, 'rb') as f:
+                tree = json.load(f)
+            logger.debug(f"parse_cache: disk hit {entry_path}")
+            return tree
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"parse_cache: failed to load {entry_path}: {e}")
+
+        tree = loader(data)
+        try:
+            tree = _to_plain(tree)
+        except TypeError as e:
+            logger.debug(f"parse_cache: {path} has values JSON can not keep, not stored: {e}")
+            return tree
+        try:
+            self._store(entry_dir, digest, entry_path, tree)
+        except Exception as e:
+            logger.warning(f"parse_cache: failed to store {entry_path}: {e}")
+        return tree
+
+    def remove(self, path: str) -> None:
+        entry_dir = self._entry_dir(path)
+        if os.path.exists(entry_dir):
+            logger.debug(f"parse_cache: removing {entry_dir}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def _entry_dir(self, path: str) -> str:
+        return os.path.join(self._directory, os.path.basename(path))
+
+    def _ensure_private(self) -> bool:
+        try:
+            if not self._is_private():
+                if os.path.lexists(self._directory):
+                    # e.g. chowned along with runtime dir by initialize_plugin
+                    logger.info(f"parse_cache: recreating {self._directory} as private")
+                    if os.path.isdir(self._directory) and not os.path.islink(self._directory):
+                        shutil.rmtree(self._directory)
+                    else:
+                        os.remove(self._directory)
+                os.makedirs(self._directory, mode=0o700)
+            if self._is_private():
+                return True
+        except OSError as e:
+            logger.warning(f"parse_cache: {self._directory} is not usable: {e}")
+            return False
+        logger.warning(f"parse_cache: {self._directory} is not private, disk cache disabled")
+        return False
+
+    def _is_private(self) -> bool:
+        try:
+            st = os.lstat(self._directory)
+        except FileNotFoundError:
+            return False
+        return stat.S_ISDIR(st.st_mode) and st.st_uid == os.geteuid() and not st.st_mode & 0o077
+
+    def _store(self, entry_dir: str, digest: str, entry_path: str, tree: Any) -> None:
+        os.makedirs(entry_dir, mode=0o700, exist_ok=True)
+        for name in os.listdir(entry_dir):
+            if not name.startswith(digest):
+                os.remove(os.path.join(entry_dir, name))
+        utils.atomic_write(entry_path, lambda f: json.dump(tree, f, ensure_ascii=False, separators=(',', ':')))
+
+
+def remove_legacy_cache() -> None:
+    if os.path.exists(LEGACY_CACHE_DIR):
+        logger.info(f"parse_cache: removing legacy cache {LEGACY_CACHE_DIR}")
+        shutil.rmtree(LEGACY_CACHE_DIR, ignore_errors=True)
+
+
+def _to_plain(value: Any) -> Any:
+    """
+    Copy of a parsed tree with loader subclasses replaced by builtin JSON types
+    Raises:
+        TypeError: When a value has no JSON counterpart, e.g. timestamps or non-string keys
+    """
+    t = type(value)
+    if t in (str, int, float, bool, type(None)):
+        return value
+    if isinstance(value, dict):
+        plain = {}
+        for k, v in value.items():
+            if not isinstance(k, str):
+                raise TypeError(f"non-string key {k!r}")
+            plain[str(k)] = _to_plain(v)
+        return plain
+    if isinstance(value, list):
+        return [_to_plain(v) for v in value]
+    # round-trip loader yields int-based booleans under anchors
+    if isinstance(value, (bool, ScalarBoolean)):
+        return bool(value)
+    for base in (str, int, float):
+        if isinstance(value, base):
+            return base(value)
+    raise TypeError(f"{t.__name__} value")
@@ -0,0 +1,120 @@
+import asyncio
+import os
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from decky import logger
+from ring_buffer import RingBuffer
+
+_CLK_TCK = os.sysconf('SC_CLK_TCK')
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# readings within these bounds of the previous sample count as steady
+_STEADY_CPU = 2.0
+_STEADY_RSS = 0.02
+
+FIELDS = ['time', 'core_cpu', 'core_rss', 'core_fds', 'plugin_cpu', 'plugin_rss', 'plugin_fds']
+
+# (cpu ticks, rss bytes, open fds)
+ProcReading = Tuple[int, int, int]
+
+
+def read_proc(pid: int) -> Optional[ProcReading]:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+        with open(f"/proc/{pid}/statm") as f:
+            rss_pages = int(f.read().split()[1])
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    # fields after comm, utime and stime are fields 14 and 15
+    fields = stat.rsplit(')', 1)[1].split()
+    return int(fields[11]) + int(fields[12]), rss_pages * _PAGE_SIZE, fds
+
+
+class ResourceSampler:
+    """
+    Periodic sampler of cpu, memory and fd usage of core and plugin processes from /proc.
+    The interval doubles while readings are steady and drops back when they change.
+    """
+
+    def __init__(
+            self,
+            core_pid: Callable[[], Optional[int]],
+            capacity: int = 720,
+            min_interval: float = 1.0,
+            max_interval: float = 16.0,
+            ):
+        self._core_pid = core_pid
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._samples = RingBuffer(capacity, FIELDS)
+        self._previous: Dict[str, Tuple[int, int, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self, points: int) -> Dict[str, Any]:
+        return {
+            "current": self._samples.latest(),
+            "series": self._samples.downsample(points),
+        }
+
+    async def _run(self) -> None:
+        interval = self._min_interval
+        last = None
+        while True:
+            try:
+                sample = self._sample()
+                self._samples.append(sample)
+                interval = min(interval * 2, self._max_interval) if _steady(last, sample) else self._min_interval
+                last = sample
+            except Exception as e:
+                logger.error(f"resource_sampler: failed with {e}")
+                interval = self._max_interval
+            await asyncio.sleep(interval)
+
+    def _sample(self) -> Dict[str, Optional[float]]:
+        now = time.monotonic()
+        sample: Dict[str, Optional[float]] = {'time': time.time()}
+        for name, pid in (('core', self._core_pid()), ('plugin', os.getpid())):
+            reading = read_proc(pid) if pid is not None else None
+            if reading is None:
+                self._previous.pop(name, None)
+                continue
+            ticks, rss, fds = reading
+            previous = self._previous.get(name)
+            if previous is not None and previous[0] == pid and now > previous[2]:
+                sample[f'{name}_cpu'] = (ticks - previous[1]) / _CLK_TCK / (now - previous[2]) * 100
+            self._previous[name] = (pid, ticks, now)
+            sample[f'{name}_rss'] = rss
+            sample[f'{name}_fds'] = fds
+        return sample
+
+
+def _steady(last: Optional[Dict[str, Optional[float]]], sample: Dict[str, Optional[float]]) -> bool:
+    if last is None:
+        return False
+    for name in ('core', 'plugin'):
+        cpu, last_cpu = sample.get(f'{name}_cpu'), last.get(f'{name}_cpu')
+        rss, last_rss = sample.get(f'{name}_rss'), last.get(f'{name}_rss')
+        if (cpu is None) != (last_cpu is None) or (rss is None) != (last_rss is None):
+            return False
+        if cpu is not None and last_cpu is not None and abs(cpu - last_cpu) > _STEADY_CPU:
+            return False
+        if rss is not None and last_rss and abs(rss - last_rss) / last_rss > _STEADY_RSS:
+            return False
+    return True
@@ -0,0 +1,71 @@
+from array import array
+import math
+from typing import Dict, List, Optional, Sequence
+
+
+class RingBuffer:
+    """
+    Fixed-capacity ring of numeric records, one preallocated array per field.
+    Missing values are stored as NaN and reported as None.
+    """
+
+    def __init__(self, capacity: int, fields: Sequence[str]):
+        self._capacity = capacity
+        self._fields = list(fields)
+        self._arrays = {field: array('d', [math.nan]) * capacity for field in self._fields}
+        self._next = 0
+        self._size = 0
+
+    @property
+    def fields(self) -> List[str]:
+        return list(self._fields)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, values: Dict[str, Optional[float]]) -> None:
+        for field, arr in self._arrays.items():
+            value = values.get(field)
+            arr[self._next] = math.nan if value is None else value
+        self._next = (self._next + 1) % self._capacity
+        self._size = min(self._size + 1, self._capacity)
+
+    def clear(self) -> None:
+        self._next = 0
+        self._size = 0
+
+    def latest(self) -> Optional[Dict[str, Optional[float]]]:
+        if self._size == 0:
+            return None
+        i = (self._next - 1) % self._capacity
+        return {field: _value(arr[i]) for field, arr in self._arrays.items()}
+
+    def series(self, field: str) -> List[Optional[float]]:
+        return [_value(v) for v in self._ordered(self._arrays[field])]
+
+    def downsample(self, max_points: int) -> Dict[str, List[Optional[float]]]:
+        """
+        Chronological series of every field, averaging consecutive records into at most max_points buckets
+        """
+        result = {}
+        for field, arr in self._arrays.items():
+            values = self._ordered(arr)
+            if max_points <= 0 or len(values) <= max_points:
+                result[field] = [_value(v) for v in values]
+                continue
+            buckets = []
+            for b in range(max_points):
+                chunk = [v for v in values[b * len(values) // max_points:(b + 1) * len(values) // max_points]
+                         if not math.isnan(v)]
+                buckets.append(sum(chunk) / len(chunk) if chunk else None)
+            result[field] = buckets
+        return result
+
+    def _ordered(self, arr: array) -> array:
+        if self._size < self._capacity:
+            return arr[:self._size]
+        return arr[self._next:] + arr[:self._next]
+
+
+def _value(v: float) -> Optional[float]:
+    return None if math.isnan(v) else v
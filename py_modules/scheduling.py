@@ -0,0 +1,210 @@
+import ctypes
+import os
+import platform
+import re
+import shutil
+from typing import Any, Callable, Dict, List, Optional
+
+from decky import logger
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# cgroup.subtree_control of the loader's own cgroup can not be written while the loader lives in it,
+# so limits are applied by starting core in a transient scope
+SYSTEMD_RUN = "systemd-run"
+SYSTEMD_RUNTIME_DIR = "/run/systemd/system"
+CPU_PERIOD_DEFAULT = 100000
+_MEMORY_RE = re.compile(r'\d+[KMGT]?')
+
+IOPRIO_CLASSES = ["none", "realtime", "best-effort", "idle"]
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+_SYS_IOPRIO = {
+    "x86_64": (251, 252),
+    "aarch64": (30, 31),
+}
+
+# nice, ionice ("class" or "class:level"), cpus, cpu_max and memory_high, empty values are left alone
+SchedulingProfile = Dict[str, Any]
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+def parse_ionice(value: str) -> Optional[int]:
+    """
+    Parse "class[:level]" into an ioprio value
+    Raises:
+        ValueError: When value is invalid
+    """
+    if not value:
+        return None
+    name, _, level = value.partition(":")
+    if name not in IOPRIO_CLASSES:
+        raise ValueError(f"invalid ionice class: {name}")
+    data = int(level) if level else 0
+    if not 0 <= data <= 7:
+        raise ValueError(f"invalid ionice level: {level}")
+    return (IOPRIO_CLASSES.index(name) << _IOPRIO_CLASS_SHIFT) | data
+
+
+def _ioprio_syscall(index: int, *args: int) -> int:
+    numbers = _SYS_IOPRIO.get(platform.machine())
+    if numbers is None:
+        raise OSError(f"ioprio is not supported on {platform.machine()}")
+    result = _libc.syscall(numbers[index], *args)
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+
+def validate(profile: SchedulingProfile) -> SchedulingProfile:
+    """
+    Replace invalid values of profile with empty ones
+    """
+    valid = dict(profile)
+    nice = profile.get("nice") or 0
+    if not isinstance(nice, int) or not -20 <= nice <= 19:
+        logger.warning(f"validate: invalid nice: {nice}")
+        valid["nice"] = 0
+    try:
+        parse_ionice(profile.get("ionice") or "")
+    except ValueError as e:
+        logger.warning(f"validate: {e}")
+        valid["ionice"] = ""
+    cpus = profile.get("cpus") or []
+    available = os.sched_getaffinity(0)
+    if not isinstance(cpus, list) or not all(isinstance(cpu, int) and cpu in available for cpu in cpus):
+        logger.warning(f"validate: invalid cpus: {cpus}, available: {sorted(available)}")
+        valid["cpus"] = []
+    for key in ("cpu_max", "memory_high"):
+        try:
+            scope_properties({key: profile.get(key)})
+        except (ValueError, AttributeError):
+            logger.warning(f"validate: invalid {key}: {profile.get(key)}")
+            valid[key] = ""
+    return valid
+
+
+def preexec(profile: SchedulingProfile) -> Optional[Callable[[], None]]:
+    """
+    Build the function run in the forked child before exec, so every thread of core inherits the profile.
+    It must not log or take locks, and refusals are left to be found by read_back.
+    Returns:
+        Optional[Callable[[], None]]: None when nothing is to be applied, which keeps the fast spawn path
+    """
+    nice = profile.get("nice") or 0
+    try:
+        ioprio = parse_ionice(profile.get("ionice") or "")
+    except ValueError as e:
+        logger.warning(f"preexec: ignoring ionice: {e}")
+        ioprio = None
+    cpus = profile.get("cpus") or []
+    if not nice and ioprio is None and not cpus:
+        return None
+
+    def _apply() -> None:
+        if nice:
+            try:
+                os.nice(nice)
+            except OSError:
+                pass
+        if ioprio is not None:
+            try:
+                _ioprio_syscall(0, _IOPRIO_WHO_PROCESS, 0, ioprio)
+            except OSError:
+                pass
+        if cpus:
+            try:
+                os.sched_setaffinity(0, cpus)
+            except (OSError, ValueError, OverflowError):
+                pass
+    return _apply
+
+
+def scope_properties(profile: SchedulingProfile) -> List[str]:
+    """
+    Translate cgroup limits of profile into systemd unit properties
+    Raises:
+        ValueError: When a limit is invalid
+    """
+    properties = []
+    cpu_max = (profile.get("cpu_max") or "").split()
+    if cpu_max and cpu_max[0] != "max":
+        try:
+            quota = int(cpu_max[0])
+            period = int(cpu_max[1]) if len(cpu_max) == 2 else CPU_PERIOD_DEFAULT
+        except ValueError:
+            quota = period = 0
+        if len(cpu_max) > 2 or quota <= 0 or period <= 0:
+            raise ValueError(f"invalid cpu_max: {' '.join(cpu_max)}")
+        properties.append(f"CPUQuota={max(1, round(quota * 100 / period))}%")
+        properties.append(f"CPUQuotaPeriodSec={period}us")
+    memory_high = (profile.get("memory_high") or "").strip()
+    if memory_high and memory_high != "max":
+        if _MEMORY_RE.fullmatch(memory_high) is None:
+            raise ValueError(f"invalid memory_high: {memory_high}")
+        properties.append(f"MemoryHigh={memory_high}")
+    return properties
+
+
+def scope_command(profile: SchedulingProfile) -> List[str]:
+    """
+    Build the command prefix starting core in a transient systemd scope carrying the cgroup limits of profile.
+    systemd-run execs core in place, so the spawned pid is core's.
+    Returns:
+        List[str]: Command prefix, empty when no limit is set or systemd is not available
+    """
+    try:
+        properties = scope_properties(profile)
+    except ValueError as e:
+        logger.warning(f"scope_command: ignoring cgroup limits: {e}")
+        return []
+    if not properties:
+        return []
+    systemd_run = shutil.which(SYSTEMD_RUN)
+    if systemd_run is None or not os.path.isdir(SYSTEMD_RUNTIME_DIR):
+        logger.warning("scope_command: systemd is not available, cgroup limits are not applied")
+        return []
+    command = [systemd_run, "--scope", "--quiet", "--collect"]
+    for prop in properties:
+        command += ["-p", prop]
+    return command + ["--"]
+
+
+def read_back(pid: int) -> Dict[str, Any]:
+    """
+    Read scheduling values the kernel actually applied to a process
+    """
+    applied: Dict[str, Any] = {}
+    try:
+        applied["nice"] = os.getpriority(os.PRIO_PROCESS, pid)
+    except OSError:
+        applied["nice"] = None
+    try:
+        ioprio = _ioprio_syscall(1, _IOPRIO_WHO_PROCESS, pid)
+        name = IOPRIO_CLASSES[ioprio >> _IOPRIO_CLASS_SHIFT]
+        applied["ionice"] = f"{name}:{ioprio & 0x7}"
+    except (OSError, IndexError):
+        applied["ionice"] = None
+    try:
+        applied["cpus"] = sorted(os.sched_getaffinity(pid))
+    except OSError:
+        applied["cpus"] = None
+    applied["cgroup"] = None
+    applied["cpu_max"] = None
+    applied["memory_high"] = None
+    try:
+        with open(f"/proc/{pid}/cgroup") as f:
+            path = next(line[3:].strip() for line in f if line.startswith("0::"))
+        applied["cgroup"] = path
+        cgroup = os.path.join(CGROUP_ROOT, path.lstrip("/"))
+        for key, name in (("cpu_max", "cpu.max"), ("memory_high", "memory.high")):
+            try:
+                with open(os.path.join(cgroup, name)) as f:
+                    applied[key] = f.read().strip()
+            except OSError:
+                pass
+    except (OSError, StopIteration):
+        pass
+    return applied
+
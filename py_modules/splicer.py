@@ -0,0 +1,171 @@
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from decky import logger
+
+_KEY_RE = re.compile(r'''([A-Za-z0-9_][A-Za-z0-9_.\-]*|"[^"\\\n]*"|'[^'\n]*')[ \t]*:(?:[ \t\r\n]|$)''')
+_ANCHOR_RE = re.compile(r'(?:^|[\s\[{,])&([^\s\[\]{},]+)', re.MULTILINE)
+_SEQ_ITEM_RE = re.compile(r'([ \t]*)- ')
+
+Section = Tuple[Optional[str], str]
+
+
+class Unsupported(Exception):
+    pass
+
+
+def split_sections(text: str) -> List[Section]:
+    """
+    Split a block mapping document at its top-level keys.
+    The first section holds the preamble (comments, document start) with key None.
+    Raises Unsupported for anything that cannot be split safely.
+    """
+    sections: List[Section] = []
+    key: Optional[str] = None
+    start = 0
+    pos = 0
+    seen_doc_start = False
+    seen_keys = set()
+    for line in text.splitlines(keepends=True):
+        c = line[0]
+        if c in ' \r\n#':
+            pass
+        elif c == '\t':
+            raise Unsupported('tab indentation at top level')
+        elif line.startswith('---') and line[3:4] in ('', ' ', '\r', '\n'):
+            if seen_doc_start or key is not None:
+                raise Unsupported('multiple documents')
+            seen_doc_start = True
+        elif c == '-' and line[1:2] in ('', ' ', '\r', '\n'):
+            # block sequence written at the indentation of its key
+            if key is None:
+                raise Unsupported('sequence root')
+        elif c in '%.':
+            raise Unsupported('directive or document end')
+        elif c in '{[':
+            raise Unsupported('flow style root')
+        else:
+            m = _KEY_RE.match(line)
+            if m is None:
+                raise Unsupported(f'unrecognized top-level line: {line[:40]!r}')
+            new_key = m.group(1)
+            if new_key[0] in '"\'':
+                new_key = new_key[1:-1]
+            if new_key == '<<':
+                raise Unsupported('top-level merge key')
+            if new_key in seen_keys:
+                raise Unsupported(f'duplicated key: {new_key}')
+            rest = line[m.end():].strip()
+            if rest[:1] in ('"', "'") and not _is_closed(rest):
+                raise Unsupported(f'multi-line quoted value: {new_key}')
+            seen_keys.add(new_key)
+            sections.append((key, text[start:pos]))
+            key = new_key
+            start = pos
+        pos += len(line)
+    sections.append((key, text[start:pos]))
+    if len(sections) == 1:
+        raise Unsupported('no top-level mapping')
+    _check_anchors(sections)
+    return sections
+
+
+def has_anchors(text: str) -> bool:
+    return '&' in text and _ANCHOR_RE.search(text) is not None
+
+
+def _is_closed(scalar: str) -> bool:
+    # whether a quoted scalar ends on its line, \" escapes a double quote and '' a single one
+    quote = scalar[0]
+    i = 1
+    while i < len(scalar):
+        c = scalar[i]
+        if quote == '"' and c == '\\':
+            i += 2
+            continue
+        if c == quote:
+            if quote == "'" and scalar[i + 1:i + 2] == "'":
+                i += 2
+                continue
+            return True
+        i += 1
+    return False
+
+
+def _check_anchors(sections: List[Section]) -> None:
+    owners: Dict[str, int] = {}
+    for i, (_, body) in enumerate(sections):
+        if '&' not in body:
+            continue
+        for name in _ANCHOR_RE.findall(body):
+            owners.setdefault(name, i)
+    for name, owner in owners.items():
+        alias = re.compile(re.escape('*' + name) + r'(?![^\s\[\]{},])')
+        for i, (_, body) in enumerate(sections):
+            if i != owner and alias.search(body):
+                raise Unsupported(f'alias *{name} crosses sections')
+
+
+def _prepend_sequence(body: str, items: Any, dump: Callable[[Any], str]) -> Optional[str]:
+    header, sep, rest = body.partition('\n')
+    if header.split('#', 1)[0].split(':', 1)[1].strip():
+        return None
+    for line in rest.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        m = _SEQ_ITEM_RE.match(line)
+        if m is None:
+            return None
+        indent = m.group(1)
+        break
+    else:
+        return None
+    prefix = ''.join(indent + line + '\n' for line in dump(items).splitlines())
+    return header + sep + prefix + rest
+
+
+def splice(
+        text: str,
+        overrides: Dict[str, Any],
+        prepends: Dict[str, Any],
+        dump: Callable[[Any], str],
+        load: Callable[[str], Any],
+        ) -> str:
+    """
+    Replace top-level keys of a document without parsing the untouched sections
+    Args:
+        text: Original document
+        overrides: Top-level values to replace or append, in order
+        prepends: Top-level sequences to prepend items to
+        dump: Serializer of a python object to document text
+        load: Parser of document text
+    Returns:
+        str: Spliced document
+    Raises:
+        Unsupported: When the document has to go through a full round-trip
+    """
+    sections = split_sections(text)
+    overrides = dict(overrides)
+    out: List[str] = []
+    present = set()
+    for key, body in sections:
+        present.add(key)
+        if body and not body.endswith('\n'):
+            body += '\n'
+        if key in overrides:
+            out.append(dump({key: overrides.pop(key)}))
+        elif key in prepends:
+            spliced = _prepend_sequence(body, prepends[key], dump)
+            if spliced is None:
+                logger.debug(f'splice: parsing section {key}')
+                spliced = dump({key: prepends[key] + (load(body)[key] or [])})
+            out.append(spliced)
+        else:
+            out.append(body)
+    missing = [k for k in prepends if k not in present]
+    if missing:
+        raise Unsupported(f'missing keys: {missing}')
+    if overrides:
+        out.append(dump(overrides))
+    return ''.join(out)
@@ -50,7 +50,7 @@ def _deduplicate_name(now_subs: SubscriptionDict, filename: str) -> Optional[str
             return None
     return filename
 
-def download_sub(
+async def download_sub(
     url: str,
     now_subs: SubscriptionDict,
     timeout: Optional[float] = None,
@@ -123,18 +123,18 @@ def download_sub(
         logger.error(f"download_sub: io error: {e}")
         return False, f"IO error: {e}"
     
-    valid = core.CoreController.check_config(path)
+    valid, error = await core.CoreController.check_config(path)
     if not valid:
         logger.error("download_sub: invalid config")
         try:
             os.remove(get_path(filename))
         except Exception as e:
             logger.error(f"download_sub: error removing file: {e}")
-        return False, "Invalid config"
+        return False, f"Invalid config: {error}"
     
     return True, (filename, url)
 
-def import_sub(file_name: str, data: bytes, now_subs: SubscriptionDict) -> Tuple[bool, Subscription | str]:
+async def import_sub(file_name: str, data: bytes, now_subs: SubscriptionDict) -> Tuple[bool, Subscription | str]:
     """
     Import subscription from file data
     Args:
@@ -174,14 +174,14 @@ def import_sub(file_name: str, data: bytes, now_subs: SubscriptionDict) -> Tuple
         logger.error(f"import_sub: io error: {e}")
         return False, f"IO error: {e}"
 
-    valid = core.CoreController.check_config(path)
+    valid, error = await core.CoreController.check_config(path)
     if not valid:
         logger.error("import_sub: invalid config")
         try:
             os.remove(get_path(filename))
         except Exception as e:
             logger.error(f"import_sub: error removing file: {e}")
-        return False, "Invalid config"
+        return False, f"Invalid config: {error}"
 
     return True, (filename, f"local://{filename}")
 
@@ -204,10 +204,10 @@ async def update_sub(name: str, url: str, timeout: float, user_agent: Optional[s
 
         await utils.get_url_to_file(req, temp_path, timeout)
 
-        valid = core.CoreController.check_config(temp_path)
+        valid, error = await core.CoreController.check_config(temp_path)
         if not valid:
             logger.error(f"update_sub: invalid config for {name}")
-            raise ValueError("Invalid config")
+            raise ValueError(f"Invalid config: {error}")
 
         if os.path.exists(target_path):
             os.remove(target_path)
@@ -0,0 +1,112 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import aiohttp
+
+from controller import ControllerClient, ControllerError
+from decky import logger
+from ring_buffer import RingBuffer
+
+FIELDS = ['time', 'up', 'down', 'connections']
+# 1 s for 5 min, 1 min for 24 h
+SECOND_CAPACITY = 300
+MINUTE_CAPACITY = 1440
+# core sends the whole connection list every interval, so it is polled slower than traffic
+CONNECTIONS_INTERVAL_MS = 5000
+RETRY_MIN_INTERVAL = 1.0
+RETRY_MAX_INTERVAL = 30.0
+
+
+class TrafficAggregator:
+    """
+    Consumer of core traffic and connection streams, keeping per-second samples and per-minute averages
+    in preallocated ring buffers, so memory and cost per sample stay constant however long it runs.
+    """
+
+    def __init__(self, client: ControllerClient, is_running: Callable[[], bool]):
+        self._client = client
+        self._is_running = is_running
+        self._seconds = RingBuffer(SECOND_CAPACITY, FIELDS)
+        self._minutes = RingBuffer(MINUTE_CAPACITY, FIELDS)
+        self._minute: Optional[int] = None
+        # field => (sum, count) of the current minute, missing values are left out
+        self._sums: Dict[str, List[float]] = {field: [0.0, 0] for field in FIELDS[1:]}
+        self._connections: Optional[int] = None
+        self._totals: Dict[str, Optional[int]] = {"upload_total": None, "download_total": None}
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._follow("traffic", self._client.traffic, self._on_traffic)),
+                asyncio.create_task(self._follow(
+                    "connections",
+                    lambda: self._client.watch_connections(CONNECTIONS_INTERVAL_MS),
+                    self._on_connections,
+                )),
+            ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    def snapshot(self, points: int) -> Dict[str, Any]:
+        return {
+            "current": {**(self._seconds.latest() or {}), **self._totals} if len(self._seconds) else None,
+            "seconds": self._seconds.downsample(points),
+            "minutes": self._minutes.downsample(points),
+        }
+
+    async def _follow(
+            self,
+            name: str,
+            stream: Callable[[], AsyncIterator[Dict[str, Any]]],
+            handle: Callable[[Dict[str, Any]], None],
+            ) -> None:
+        interval = RETRY_MIN_INTERVAL
+        while True:
+            if not self._is_running():
+                # picks core up soon after it starts
+                interval = RETRY_MIN_INTERVAL
+                await asyncio.sleep(interval)
+                continue
+            try:
+                async for message in stream():
+                    handle(message)
+                    interval = RETRY_MIN_INTERVAL
+            except (ControllerError, aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.debug(f"traffic: {name} stream failed with {e}")
+            except Exception as e:
+                logger.error(f"traffic: {name} stream failed with {e}")
+            if name == "connections":
+                self._connections = None
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, RETRY_MAX_INTERVAL)
+
+    def _on_traffic(self, message: Dict[str, Any]) -> None:
+        now = time.time()
+        sample = {'time': now, 'up': message.get('up'), 'down': message.get('down'), 'connections': self._connections}
+        self._seconds.append(sample)
+        minute = int(now // 60)
+        if self._minute is not None and minute != self._minute:
+            average: Dict[str, Optional[float]] = {'time': self._minute * 60.0}
+            for field, acc in self._sums.items():
+                average[field] = acc[0] / acc[1] if acc[1] else None
+                acc[0], acc[1] = 0.0, 0
+            self._minutes.append(average)
+        self._minute = minute
+        for field, acc in self._sums.items():
+            if sample[field] is not None:
+                acc[0] += sample[field]
+                acc[1] += 1
+
+    def _on_connections(self, message: Dict[str, Any]) -> None:
+        self._connections = len(message.get('connections') or [])
+        self._totals = {"upload_total": message.get('uploadTotal'), "download_total": message.get('downloadTotal')}
@@ -7,13 +7,16 @@ import stat
 import tempfile
 import time
 import urllib.request
-from typing import Awaitable, Callable, Coroutine, Dict, Tuple, Any
+from typing import Awaitable, Callable, Coroutine, Dict, List, Tuple, Any
+
+import aiohttp
 
 import core
 import dashboard
 import decky
 from decky import logger
 from metadata import CORE_REPO, PACKAGE_REPO
+import parse_cache
 import utils
 import config
 
@@ -130,7 +133,7 @@ async def upgrade_plugin(version: str) -> None:
 
 async def upgrade_core(version: str) -> None:
     logger.info("upgrade_core: upgrading")
-    downloaded_filepath = await download_resourse(ResourceType.CORE, version)
+    downloaded_filepath, variant = await download_core(version)
     core_path = core.CoreController.CORE_PATH
 
     if os.path.exists(downloaded_filepath):
@@ -146,6 +149,11 @@ async def upgrade_core(version: str) -> None:
         await asyncio.to_thread(_impl)
         os.chmod(core_path, 0o755)
         shutil.chown(core_path, decky.DECKY_USER, decky.DECKY_USER)
+        with open(CORE_VARIANT_PATH, "w") as f:
+            f.write(variant)
+        core.CoreController.clear_validation_cache()
+        core.CoreController.invalidate_version()
+        await core.CoreController.get_version()
         # cleanup downloaded files
         remove_no_fail(downloaded_filepath)
 
@@ -162,13 +170,82 @@ _URL_MAP: Dict[ResourceType, Callable[[str], str]] = {
         if ver.startswith("nightly-")
         else f"https://github.com/{PACKAGE_REPO}/releases/download/{ver}/DeckyClash.zip"
     ),
-    ResourceType.CORE: lambda ver: (
-        f"https://github.com/{CORE_REPO}/releases/download/Prerelease-Alpha/mihomo-linux-amd64-{ver}.gz"
-        if ver.startswith("alpha-")
-        else f"https://github.com/{CORE_REPO}/releases/download/{ver}/mihomo-linux-amd64-{ver}.gz"
-    ),
 }
 
+def _core_url(ver: str, variant: str) -> str:
+    asset = f"mihomo-linux-amd64-{variant}-{ver}.gz" if variant else f"mihomo-linux-amd64-{ver}.gz"
+    if ver.startswith("alpha-"):
+        return f"https://github.com/{CORE_REPO}/releases/download/Prerelease-Alpha/{asset}"
+    return f"https://github.com/{CORE_REPO}/releases/download/{ver}/{asset}"
+
+CORE_VARIANT_PATH = os.path.join(decky.DECKY_PLUGIN_DIR, "bin", "mihomo.variant")
+
+# cpuinfo flags each x86-64 microarchitecture level adds to the previous one
+_X86_64_LEVEL_FLAGS = {
+    2: {"cx16", "lahf_lm", "popcnt", "pni", "sse4_1", "sse4_2", "ssse3"},
+    3: {"abm", "avx", "avx2", "bmi1", "bmi2", "f16c", "fma", "movbe", "xsave"},
+}
+
+def detect_x86_64_level() -> int:
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = next(set(line.split(":", 1)[1].split()) for line in f if line.startswith("flags"))
+    except (OSError, StopIteration) as e:
+        logger.warning(f"detect_x86_64_level: failed to read cpu flags: {e}")
+        return 1
+    level = 1
+    for lv, required in sorted(_X86_64_LEVEL_FLAGS.items()):
+        if not required <= flags:
+            break
+        level = lv
+    return level
+
+def core_variants() -> List[str]:
+    """
+    Core build variants the host can run, in preference order. The plain build targets v3 hosts.
+    """
+    level = detect_x86_64_level()
+    variants = [f"v{lv}" for lv in range(level, 0, -1)]
+    if level >= 3:
+        variants.insert(1, "")
+    variants.append("compatible")
+    return variants
+
+def get_core_variant() -> str:
+    try:
+        with open(CORE_VARIANT_PATH) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+async def download_core(version: str) -> Tuple[str, str]:
+    """
+    Download the best core build for this host, falling back when an asset is missing
+    Returns:
+        tuple(str, str)
+        str: Downloaded file path
+        str: Variant of downloaded build, empty for the plain build
+    """
+    variants = core_variants()
+    logger.debug(f"download_core: candidates {variants}")
+    try:
+        for variant in variants:
+            url = _core_url(version, variant)
+            name = url.split("/")[-1]
+            try:
+                path = await utils.download_with_progress(url, name, lambda percent: decky.emit("dl_core_progress", percent))
+            except aiohttp.ClientResponseError as e:
+                if e.status != 404:
+                    raise
+                logger.warning(f"download_core: {name} not found, trying next variant")
+                continue
+            logger.info(f"download_core: downloaded {variant or 'plain'} build")
+            return path, variant
+        raise FileNotFoundError(f"no core build of {version} found for variants {variants}")
+    finally:
+        # a failed download leaves the last percentage shown otherwise
+        await decky.emit("dl_core_progress", -1)
+
 _VERSION_URL_MAP: Dict[ResourceType, Callable[[str], str]] = {
     ResourceType.PLUGIN: lambda channel: (
         f"https://github.com/{PACKAGE_REPO}/releases/download/nightly/version.txt"
@@ -258,6 +335,8 @@ async def download_geos():
     for filename, url in _GEO_FILES.items():
         promises.append(_impl(filename, url))
     await asyncio.gather(*promises)
+    # verdicts of configs referring to geodata were made against the old files
+    core.CoreController.clear_validation_cache()
 
 async def download_dashboards():
     promises = []
@@ -321,3 +400,5 @@ def initialize_plugin() -> None:
         shutil.copytree(data_path, decky.DECKY_PLUGIN_RUNTIME_DIR, dirs_exist_ok=True)
         shutil.rmtree(data_path)
         recursive_chown(decky.DECKY_PLUGIN_RUNTIME_DIR, decky.DECKY_USER, decky.DECKY_USER)
+    # pickles under settings dir, which the user and backup restore can write
+    parse_cache.remove_legacy_cache()
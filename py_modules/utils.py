@@ -10,12 +10,16 @@ import urllib.request
 import fcntl
 import struct
 import socket
-from typing import Any, Awaitable, Callable, List, Optional
+from typing import Any, Awaitable, Callable, List, Optional, TextIO
 
 import aiohttp
 
+import decky
 from decky import logger
 
+# settings of Decky Loader itself
+LOADER_SETTINGS = os.path.join(decky.DECKY_HOME, "settings", "loader.json")
+
 _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 SIOCGIFADDR = 0x8915
 _sockfd = _sock.fileno()
@@ -124,6 +128,33 @@ def get_traceback(e: BaseException) -> str:
     import traceback
     return '\n'.join(traceback.format_exception(e))
 
+def atomic_write(path: str, write: Callable[[TextIO], Any], buffering: int = -1) -> None:
+    """
+    Write a file through a temporary sibling, so readers only ever see the old or the complete new content
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path), suffix='.tmp')
+    try:
+        with open(fd, 'w', encoding='utf-8', buffering=buffering) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+def is_plugin_disabled() -> bool:
+    # loader records a plugin as disabled before unloading it
+    try:
+        with open(LOADER_SETTINGS) as f:
+            return decky.DECKY_PLUGIN_NAME in json.load(f).get("disabled_plugins", [])
+    except Exception as e:
+        logger.debug(f"is_plugin_disabled: failed to read {LOADER_SETTINGS}: {e}")
+        return False
+
 ProgressCallback = Callable[[int], Awaitable]
 async def download_with_progress(url: str, name: str, progress_callback: ProgressCallback) -> str:
     with tempfile.NamedTemporaryFile("wb", suffix=name, delete=False) as f:
@@ -131,22 +162,28 @@ async def download_with_progress(url: str, name: str, progress_callback: Progres
         downloaded_size = 0
         last_percent = 0
         await progress_callback(0)
-        async with aiohttp.ClientSession(
-            connector=aiohttp.TCPConnector(ssl=get_ssl_context()),
-            timeout=aiohttp.ClientTimeout(0)) as session:
-            async with session.get(url) as response:
-                total_size = int(response.headers.get("Content-Length", 0))
-                logger.debug(f"downloading: {total_size} bytes")
-                while True:
-                    chunk = await response.content.read(128*1024)
-                    if not chunk:
-                        break
-                    f.write(chunk)
-                    downloaded_size += len(chunk)
-                    percent = int(downloaded_size / total_size * 100)
-                    if percent > last_percent:
-                        last_percent = percent
-                        logger.debug(f"downloading: {percent}%")
-                        await progress_callback(last_percent)
+        try:
+            async with aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(ssl=get_ssl_context()),
+                timeout=aiohttp.ClientTimeout(0)) as session:
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    total_size = int(response.headers.get("Content-Length", 0))
+                    logger.debug(f"downloading: {total_size} bytes")
+                    while True:
+                        chunk = await response.content.read(128*1024)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        downloaded_size += len(chunk)
+                        percent = int(downloaded_size / total_size * 100)
+                        if percent > last_percent:
+                            last_percent = percent
+                            logger.debug(f"downloading: {percent}%")
+                            await progress_callback(last_percent)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
         await progress_callback(-1)
         return f.name
@@ -16,6 +16,8 @@ from decky import logger
 
 SUCCESS_STATUS = {200, 201, 204}
 PROPFIND_SUCCESS_STATUS = {200, 207}
+# regenerable caches under settings directory, not worth backing up
+EXCLUDED_DIRS = {"subscriptions_cache"}
 
 
 def _auth(username: str, password: str) -> Optional[aiohttp.BasicAuth]:
@@ -76,6 +78,8 @@ def _create_archive(settings_dir: str, archive_path: str) -> None:
 
     with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
         for path in root.rglob("*"):
+            if path.relative_to(root).parts[0] in EXCLUDED_DIRS:
+                continue
             if path.is_file():
                 archive.write(path, path.relative_to(root).as_posix())
 
@@ -102,7 +106,11 @@ def _replace_settings_from_archive(settings_dir: str, archive_path: str) -> None
     _validate_archive(archive_path)
     with tempfile.TemporaryDirectory() as extract_dir:
         with zipfile.ZipFile(archive_path) as archive:
-            archive.extractall(extract_dir)
+            members = [
+                info for info in archive.infolist()
+                if posixpath.normpath(info.filename.replace("\\", "/")).split("/")[0] not in EXCLUDED_DIRS
+            ]
+            archive.extractall(extract_dir, members)
 
         _clear_directory(settings_dir)
         shutil.copytree(extract_dir, settings_dir, dirs_exist_ok=True)
@@ -1,10 +1,22 @@
 import { callable } from "@decky/api";
-import { Config, ResourceType, WebDAVConfig } from ".";
+import { Config, ControllerBenchmark, ControllerMetrics, CoreLogLevel, CoreScheduling, CoreStartupStats, CoreStopStats, GenerationStats, LatencyStats, ProxyDelays, ResourceStats, ResourceType, TrafficStats, WebDAVConfig } from ".";
 
 export const getCoreStatus = callable<[], boolean>("get_core_status");
 export const setCoreStatus = callable<[boolean], [boolean, string]>("set_core_status");
-export const restartCore = callable<[], []>("restart_core");
+export const restartCore = callable<[], [boolean, string | null]>("restart_core");
 export const killCore = callable<[], boolean>("kill_core");
+export const getGenerationStats = callable<[], GenerationStats[]>("get_generation_stats");
+export const getCoreStartupStats = callable<[], CoreStartupStats[]>("get_core_startup_stats");
+export const getCoreStopStats = callable<[], CoreStopStats[]>("get_core_stop_stats");
+export const getCoreScheduling = callable<[], CoreScheduling>("get_core_scheduling");
+export const getResourceStats = callable<[number], ResourceStats>("get_resource_stats");
+export const getCoreLog = callable<[number], string[]>("get_core_log");
+export const searchCoreLog = callable<[CoreLogLevel | null, string | null, number], [string[], string | null]>("search_core_log");
+export const getControllerMetrics = callable<[], Record<string, ControllerMetrics>>("get_controller_metrics");
+export const benchmarkController = callable<[number], ControllerBenchmark>("benchmark_controller");
+export const testProxyLatency = callable<[string | null, boolean], [ProxyDelays, string | null]>("test_proxy_latency");
+export const getLatencyHistory = callable<[], Record<string, LatencyStats>>("get_latency_history");
+export const getTrafficStats = callable<[number], TrafficStats>("get_traffic_stats");
 
 export const getConfig = callable<[], Config>("get_config");
 export const getConfigValue = callable<[string], any>("get_config_value");
@@ -19,6 +31,7 @@ export const checkUpdate = callable<[], []>("check_update");
 export const upgrade = callable<[ResourceType, string?], [boolean, string]>("upgrade");
 export const cancelUpgrade = callable<[ResourceType], []>("cancel_upgrade");
 export const getVersion = callable<[ResourceType], string>("get_version");
+export const getCoreVariant = callable<[], string>("get_core_variant");
 export const getLatestVersion = callable<[ResourceType, string?], string>("get_latest_version");
 export const isUpgrading = callable<[ResourceType], boolean>("is_upgrading");
 
@@ -3,6 +3,14 @@ export enum EnhancedMode {
   FakeIp = "fake-ip",
 }
 
+export enum CoreLogLevel {
+  DEBUG = "debug",
+  INFO = "info",
+  WARNING = "warning",
+  ERROR = "error",
+  FATAL = "fatal",
+}
+
 export enum ResourceType {
   PLUGIN = "plugin",
   CORE = "core",
@@ -26,3 +34,114 @@ export interface WebDAVConfig {
   username: string,
   password: string,
 }
+
+export interface GenerationStats {
+  time: number,
+  method: "cached" | "splice" | "full" | "json",
+  size: number,
+  duration: number,
+  stages: Record<string, number>,
+  isolated?: boolean,
+  start_rss?: number,
+  peak_rss?: number,
+  changed?: string[],
+}
+
+export interface CoreStartupStats {
+  time: number,
+  version: string,
+  label: string,
+  ready: boolean,
+  latency: number,
+}
+
+export interface CoreStopStats {
+  time: number,
+  method: "terminate" | "kill" | "pkill",
+  returncode: number | null,
+  latency: number,
+}
+
+export interface ResourceSample {
+  time: number,
+  core_cpu: number | null,
+  core_rss: number | null,
+  core_fds: number | null,
+  plugin_cpu: number | null,
+  plugin_rss: number | null,
+  plugin_fds: number | null,
+}
+
+export interface ResourceStats {
+  current: ResourceSample | null,
+  series: { [K in keyof ResourceSample]: ResourceSample[K][] },
+}
+
+export interface SchedulingProfile {
+  nice: number,
+  ionice: string,
+  cpus: number[],
+  cpu_max: string,
+  memory_high: string,
+}
+
+export interface CoreScheduling {
+  profile: Partial<SchedulingProfile>,
+  applied: {
+    nice: number | null,
+    ionice: string | null,
+    cpus: number[] | null,
+    cgroup: string | null,
+    cpu_max: string | null,
+    memory_high: string | null,
+  } | null,
+}
+
+export interface ControllerMetrics {
+  count: number,
+  errors: number,
+  total: number,
+  max: number,
+  last: number,
+}
+
+export interface TransportLatency {
+  rounds: number,
+  mean: number,
+  p50: number,
+  p95: number,
+  max: number,
+}
+
+export interface ControllerBenchmark {
+  unix: TransportLatency | null,
+  tcp: TransportLatency | null,
+}
+
+// delay in ms, null when the proxy failed the test
+export type ProxyDelays = Record<string, number | null>;
+
+export interface LatencyStats {
+  samples: number,
+  last: number | null,
+  ewma: number | null,
+  p50: number | null,
+  p95: number | null,
+  loss: number,
+}
+
+export interface TrafficSample {
+  time: number,
+  up: number | null,
+  down: number | null,
+  connections: number | null,
+}
+
+export interface TrafficStats {
+  current: (TrafficSample & {
+    upload_total: number | null,
+    download_total: number | null,
+  }) | null,
+  seconds: { [K in keyof TrafficSample]: TrafficSample[K][] },
+  minutes: { [K in keyof TrafficSample]: TrafficSample[K][] },
+}
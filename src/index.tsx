@@ -329,7 +329,14 @@ const Content: FC<{}> = ({ }) => {
   const restartClash = async () => {
     if (!clashState)
       return;
-    await backend.restartCore();
+    const [success, error] = await backend.restartCore();
+    if (!success) {
+      toaster.toast({
+        title: t(L.ENABLE_CLASH_FAILED),
+        body: error,
+        icon: <DeckyClashIcon />,
+      });
+    }
   }
 
   const killClash = async () => {
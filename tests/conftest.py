@@ -0,0 +1,7 @@
+import os
+import sys
+
+_TESTS = os.path.dirname(os.path.abspath(__file__))
+
+# the decky stub goes first, py_modules are imported the way decky loader puts them on the path
+sys.path[:0] = [_TESTS, os.path.join(os.path.dirname(_TESTS), "py_modules")]
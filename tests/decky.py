@@ -0,0 +1,29 @@
+"""
+Minimal stand-in for the module decky loader provides, enough to import py_modules in tests
+"""
+import logging
+import os
+import tempfile
+from typing import Any
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_TMP = tempfile.mkdtemp(prefix="decky-clash-test-")
+
+DECKY_USER = os.environ.get("USER", "root")
+DECKY_HOME = _TMP
+DECKY_PLUGIN_NAME = "Decky Clash"
+# override.yaml is shipped from defaults into the plugin directory
+DECKY_PLUGIN_DIR = os.path.join(_ROOT, "defaults")
+DECKY_PLUGIN_SETTINGS_DIR = os.path.join(_TMP, "settings")
+DECKY_PLUGIN_RUNTIME_DIR = os.path.join(_TMP, "runtime")
+DECKY_PLUGIN_LOG_DIR = os.path.join(_TMP, "logs")
+DECKY_PLUGIN_VERSION = "0.0.0"
+
+for _dir in (DECKY_PLUGIN_SETTINGS_DIR, DECKY_PLUGIN_RUNTIME_DIR, DECKY_PLUGIN_LOG_DIR):
+    os.makedirs(_dir, exist_ok=True)
+
+logger = logging.getLogger("decky")
+
+
+async def emit(event: str, *args: Any) -> None:
+    pass
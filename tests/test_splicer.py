@@ -0,0 +1,140 @@
+from typing import Any
+
+import pytest
+from ruamel.yaml import YAML
+
+import config
+from config import Backend
+import splicer
+
+SUBSCRIPTION = '''\
+# header comment
+---
+mixed-port: 7890
+"allow-lan": false
+dns:
+  enable: true
+  nameserver: ['223.5.5.5',   "tls://1.1.1.1:853"]   # odd spacing is kept
+proxies:
+  - &hk {name: "香港 01", type: ss, server: hk.example.com, port: 8388, cipher: aes-128-gcm, password: 'it''s'}
+  - *hk
+proxy-groups:
+- name: Proxy
+  type: select
+  proxies: [香港 01, DIRECT]
+rules:
+  # comment inside the sequence
+  - DOMAIN-SUFFIX,example.com,Proxy
+  - MATCH,DIRECT
+'''
+
+
+def _yaml() -> YAML:
+    return config._new_yaml(Backend.RoundTrip)
+
+
+def _dump(data: Any) -> str:
+    return config._dump_str(_yaml(), data)
+
+
+def _plain(text: str) -> Any:
+    return YAML(typ='safe').load(text)
+
+
+@pytest.mark.parametrize('text', [
+    'a: 1\na: 2\n',
+    'a: 1\n"a": 2\n',
+    'a: 1\nsecret: "a\\"\nb: x"\n',
+    "a: 1\nsecret: 'it''\nb: x'\n",
+    'secret: "multi\n  line"\nb: 1\n',
+    'a: &x 1\nb: *x\n',
+    'a: 1\n\tb: 2\n',
+    '{a: 1}\n',
+    '[a, b]\n',
+    '- a\n- b\n',
+    '---\na: 1\n---\nb: 2\n',
+    '%YAML 1.2\n---\na: 1\n',
+    'a: 1\n...\n',
+    '<<: {a: 1}\nb: 2\n',
+    '? a\n: 1\n',
+    '# only a comment\n',
+])
+def test_unsupported(text: str):
+    with pytest.raises(splicer.Unsupported):
+        splicer.split_sections(text)
+
+
+@pytest.mark.parametrize('value', [
+    '"a\\"b"',
+    '"a\\\\"',
+    "'it''s'",
+    "''",
+    '"a # not a comment"  # a comment',
+])
+def test_closed_quoted_values(value: str):
+    text = f'a: 1\nsecret: {value}\nb: 2\n'
+    assert [k for k, _ in splicer.split_sections(text)] == [None, 'a', 'secret', 'b']
+
+
+def test_split_sections():
+    sections = splicer.split_sections(SUBSCRIPTION)
+    assert [k for k, _ in sections] == [None, 'mixed-port', 'allow-lan', 'dns', 'proxies', 'proxy-groups', 'rules']
+    assert ''.join(body for _, body in sections) == SUBSCRIPTION
+    assert sections[0][1] == '# header comment\n---\n'
+
+
+def test_anchor_within_section():
+    text = 'a:\n  - &x {k: 1}\n  - *x\nb: 2\n'
+    assert [k for k, _ in splicer.split_sections(text)] == [None, 'a', 'b']
+
+
+@pytest.mark.parametrize('body, expected', [
+    ('rules:\n  - A\n  - B\n', 'rules:\n  - X\n  - Y\n  - A\n  - B\n'),
+    ('rules:\n- A\n', 'rules:\n- X\n- Y\n- A\n'),
+    # new items go right below the key, comments stay with the items they precede
+    ('rules:  # trailing\n  # leading comment\n  - A\n', 'rules:  # trailing\n  - X\n  - Y\n  # leading comment\n  - A\n'),
+])
+def test_prepend_sequence(body: str, expected: str):
+    assert splicer._prepend_sequence(body, ['X', 'Y'], _dump) == expected
+
+
+@pytest.mark.parametrize('body', [
+    'rules: [A, B]\n',
+    'rules:\n  key: value\n',
+    'rules:\n',
+    'rules: []\n',
+])
+def test_prepend_sequence_unsupported(body: str):
+    assert splicer._prepend_sequence(body, ['X'], _dump) is None
+
+
+def test_splice_keeps_untouched_sections():
+    overrides = {'mixed-port': 7891, 'secret': 's3cr3t'}
+    prepends = {'rules': ['DOMAIN,steam.example.com,DIRECT']}
+    text = splicer.splice(SUBSCRIPTION, overrides, prepends, _dump, _yaml().load)
+
+    original = dict(splicer.split_sections(SUBSCRIPTION))
+    spliced = dict(splicer.split_sections(text))
+    for key in ('allow-lan', 'dns', 'proxies', 'proxy-groups'):
+        assert spliced[key] == original[key]
+    assert spliced[None] == original[None]
+    assert spliced['rules'].endswith(original['rules'].split('\n', 1)[1])
+
+    # same data as a full round-trip of the whole document
+    full = _yaml().load(SUBSCRIPTION)
+    full['rules'] = prepends['rules'] + full['rules']
+    full.update(overrides)
+    assert _plain(text) == _plain(_dump(full))
+
+
+def test_splice_falls_back_through_load():
+    # a flow sequence can not be prepended to in place, only that section is parsed
+    text = 'a: 1\nrules: [A, B]\n'
+    spliced = splicer.splice(text, {}, {'rules': ['X']}, _dump, _yaml().load)
+    assert spliced.startswith('a: 1\n')
+    assert _plain(spliced) == {'a': 1, 'rules': ['X', 'A', 'B']}
+
+
+def test_splice_missing_prepend_key():
+    with pytest.raises(splicer.Unsupported):
+        splicer.splice('a: 1\n', {}, {'rules': ['X']}, _dump, _yaml().load)
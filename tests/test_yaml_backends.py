@@ -0,0 +1,154 @@
+import json
+from typing import Any
+
+import pytest
+from ruamel.yaml import YAML
+from ruamel.yaml.main import CEmitter
+from ruamel.yaml.scalarbool import ScalarBoolean
+
+import config
+from config import Backend, EnhancedMode, OutputFormat
+
+# aliases cross top-level keys, so generation takes the full round-trip
+ANCHORED = '''\
+# subscription header
+mixed-port: 7890
+allow-lan: false
+mode: rule
+proxy-defaults: &defaults
+  udp: true
+  tfo: &off false
+  skip-cert-verify: ~
+proxies:
+  - <<: *defaults
+    name: "香港 01 🇭🇰"
+    type: ss
+    server: hk.example.com
+    port: 8388
+    cipher: aes-128-gcm
+    password: 'it''s "quoted"'
+  - {name: 日本 02, type: trojan, server: jp.example.com, port: 443, password: "p\\u00e4ss\\"", udp: *off}
+proxy-groups:
+  - name: Proxy
+    type: select
+    proxies: [香港 01 🇭🇰, 日本 02, DIRECT]  # trailing comment
+rules:
+  - DOMAIN-SUFFIX,example.com,Proxy
+  - MATCH,DIRECT
+'''
+
+# top-level keys only, so generation splices the document
+PLAIN = '''\
+---
+# 订阅 header
+port: 7890
+ipv6: true
+dns: {enable: true, nameserver: [223.5.5.5, "tls://1.1.1.1:853"]}
+proxies:
+  # a comment between items
+  - name: Ключ
+    type: vmess
+    server: ru.example.com
+    port: 443
+    uuid: "00000000-0000-0000-0000-000000000000"
+    ws-opts: {path: /ws, headers: {Host: ru.example.com}}
+proxy-groups:
+  - {name: Auto, type: url-test, proxies: [Ключ], interval: 300, tolerance: 50.5}
+rules:
+  - GEOIP,CN,DIRECT
+  - MATCH,Auto
+'''
+
+DOCUMENTS = {'anchored': ANCHORED, 'plain': PLAIN}
+# generation method of a YAML output
+METHODS = {'anchored': 'full', 'plain': 'splice'}
+
+
+def _load(backend: Backend, text: str) -> Any:
+    return config._new_yaml(backend).load(text)
+
+
+def _plain(data: Any) -> Any:
+    # round-trip loader yields subclasses of the builtin types, booleans under anchors are ints
+    if isinstance(data, dict):
+        return {str(k): _plain(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_plain(v) for v in data]
+    if isinstance(data, (bool, ScalarBoolean)):
+        return bool(data)
+    for t in (int, float, str):
+        if isinstance(data, t):
+            return t(data)
+    return data
+
+
+def _dumps(data: Any) -> str:
+    # bool and int compare equal, JSON tells them apart
+    return json.dumps(_plain(data), ensure_ascii=False, sort_keys=True)
+
+
+@pytest.mark.parametrize('name', DOCUMENTS)
+def test_load_parity(name: str):
+    text = DOCUMENTS[name]
+    assert _dumps(_load(Backend.RoundTrip, text)) == _dumps(_load(Backend.Fast, text))
+
+
+def test_load_values():
+    data = _plain(_load(Backend.Fast, ANCHORED))
+    hk, jp = data['proxies']
+    assert hk['name'] == '香港 01 🇭🇰'
+    assert hk['udp'] is True and hk['tfo'] is False and hk['skip-cert-verify'] is None
+    assert hk['password'] == 'it\'s "quoted"'
+    assert jp['password'] == 'päss"'
+    assert jp['udp'] is False
+    assert data['proxy-groups'][0]['proxies'] == ['香港 01 🇭🇰', '日本 02', 'DIRECT']
+
+
+def test_fast_width():
+    y = config._new_yaml(Backend.Fast)
+    assert isinstance(y.width, int)
+    line = ' '.join(['DOMAIN-SUFFIX,example.com,Proxy'] * 20)
+    assert config._dump_str(y, {'rules': [line]}) == f'rules:\n- {line}\n'
+
+
+@pytest.mark.skipif(CEmitter is None, reason='ruamel.yaml.clib is not installed')
+def test_fast_c_emitter():
+    y = config._new_yaml(Backend.Fast)
+    assert config._dump_str(y, _load(Backend.Fast, PLAIN))
+    assert y.Emitter is CEmitter
+
+
+def _generate(tmp_path, name: str, backend: Backend, output_format: OutputFormat) -> Any:
+    ori = tmp_path / f'{name}.yaml'
+    ori.write_text(DOCUMENTS[name], encoding='utf-8')
+    new = tmp_path / f'{name}-{backend.value}-{output_format.value}.yaml'
+    config.generate_config_sync(
+        str(ori),
+        str(new),
+        secret='s3cr3t',
+        override_dns=True,
+        enhanced_mode=EnhancedMode.FakeIP,
+        controller_port=9090,
+        allow_remote_access=False,
+        dashboard_dir=str(tmp_path / 'dashboard'),
+        dashboard=None,
+        skip_steam_download=True,
+        backend=backend,
+        output_format=output_format,
+    )
+    method = METHODS[name] if output_format == OutputFormat.YAML else 'json'
+    assert config.get_generation_stats()[-1]['method'] == method
+    return YAML(typ='safe').load(new.read_text(encoding='utf-8'))
+
+
+@pytest.mark.parametrize('output_format', list(OutputFormat))
+@pytest.mark.parametrize('name', DOCUMENTS)
+def test_generate_parity(tmp_path, name: str, output_format: OutputFormat):
+    roundtrip = _generate(tmp_path, name, Backend.RoundTrip, output_format)
+    fast = _generate(tmp_path, name, Backend.Fast, output_format)
+    assert _dumps(roundtrip) == _dumps(fast)
+    assert fast['secret'] == 's3cr3t'
+    assert fast['external-controller'] == '127.0.0.1:9090'
+    assert fast['dns']['enhanced-mode'] == 'fake-ip'
+    assert fast['rules'][-1] == DOCUMENTS[name].rstrip().rsplit('- ', 1)[1]
+    assert len(fast['rules']) > 2